@@ -8,5 +8,5 @@ setup (
     description='SIS ORM like library',
     packages=['sisdb'],
     keywords=['sis', 'sis-cmdb', 'orm'],
-    install_requires=['sispy >= 0.3.0']
+    install_requires=['sispy >= 1.1.0']
 )
@@ -1,7 +1,49 @@
 import schema
+import cache
+import session
+import transport
+import replica
+import util
+import collections
+import json
+import threading
+from multiprocessing.pool import ThreadPool
 
 VERSION = '0.7.4'
 
+# default number of threads running the a* (async) calls
+ASYNC_WORKERS = 16
+
+# enough of a schema to tell whether it changed
+SCHEMA_VERSION_FIELDS = 'name,__v,_updated_at,_sis._updated_at'
+
+def _schema_version(s):
+    updated_at = s.get('_updated_at', None)
+    if updated_at is None:
+        updated_at = (s.get('_sis', None) or { }).get('_updated_at', None)
+    return (updated_at, s.get('__v', None))
+
+# (path, value) of the newest _updated_at of the schemas
+def _schema_watermark(schemas):
+    path = None
+    newest = None
+    for s in schemas:
+        if s.get('_updated_at', None) is not None:
+            updated_at = s['_updated_at']
+            s_path = '_updated_at'
+        else:
+            updated_at = _schema_version(s)[0]
+            s_path = '_sis._updated_at'
+        if updated_at is None:
+            # can't tell what changed
+            return None
+        if newest is None or updated_at > newest:
+            path = s_path
+            newest = updated_at
+    if newest is None:
+        return None
+    return (path, newest)
+
 class SisDbError(Exception):
     def __init__(self, value):
         self.value = value
@@ -10,47 +52,275 @@ class SisDbError(Exception):
 
 class SisDb(object):
 
-    def __init__(self, client, opts=None):
+    def __init__(self, client, opts=None, batch_dereference=False,
+                 fetch_workers=1, identity_map=False, query_cache=None,
+                 schema_cache=None, async_workers=ASYNC_WORKERS,
+                 http_handler=None, coalesce=False):
         self.client = client
         if self.client.version < 1.1:
             raise SisDbError("API Version must be 1.1 or higher.")
+        # replace the http handler of the client, e.g. with a
+        # transport.PooledHTTPHandler to share it between threads
+        if http_handler is not None:
+            self.client._http_handler = http_handler
+        # load references with batched $in queries instead of
+        # one request per id
+        self.batch_dereference = batch_dereference
+        # max number of pages Query.all_items fetches concurrently
+        self.fetch_workers = fetch_workers
+        # share one object per (schema, _id).  True uses weak references,
+        # or pass an IdentityMap(max_size) to keep an LRU of objects alive
+        if identity_map is True:
+            identity_map = cache.IdentityMap()
+        elif identity_map is False:
+            identity_map = None
+        self.identity_map = identity_map
+        # shared cache of query results, e.g. cache.QueryCache(ttl=30)
+        self.query_cache = query_cache
+        # identical loads and queries made at the same time by
+        # different threads share a single request.  off by default
+        # since a thread can then be handed the result of a request
+        # sent before its own last write
+        self.single_flight = util.SingleFlight() if coalesce else None
+        # local copy of some schemas.  see replicate
+        self.replica = None
+        # path of a file to keep the schemas in between runs
+        if isinstance(schema_cache, basestring):
+            schema_cache = cache.SchemaCache(schema_cache)
+        self.schema_cache = schema_cache
+        # size of the thread pool behind submit and the a* methods
+        self.async_workers = async_workers
+        self._async_pool = None
+        self._async_lock = threading.Lock()
+        self._local = threading.local()
+        # descriptors by name.  classes are built on first access.
+        # both maps are replaced rather than modified (under the
+        # schema lock) so they can be read without locking
+        self._descriptors = { }
         self._schemas = { }
+        self._schema_lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        self._refresh_opts = None
+        # scalar fields by descriptor and name, an LRU.  see field._cached
+        self._field_cache = collections.OrderedDict()
+        self._schema_watermark = None
         if client is not None:
             self.refresh(opts)
 
     def __getattr__(self, name):
-        if name in self._schemas:
-            return self._schemas[name]
+        schemas = self.__dict__.get('_schemas', { })
+        if name in schemas:
+            return schemas[name]
+
+        descriptors = self.__dict__.get('_descriptors', { })
+        if name in descriptors:
+            return self._build_schema(name)
+
+        raise AttributeError(name)
+
+    def _build_schema(self, name):
+        with self._schema_lock:
+            # another thread may have built it first
+            cls = self._schemas.get(name, None)
+            if cls is not None:
+                return cls
+            desc = self._descriptors.get(name, None)
+            if desc is None:
+                raise AttributeError(name)
+            cls = schema.create_schema(self, desc)
+            schemas = dict(self._schemas)
+            schemas[name] = cls
+            self._schemas = schemas
+            return cls
+
+    def session(self, chunk_size=schema.ID_CHUNK_SIZE):
+        """ Returns a unit of work context manager.  Saves and deletes
+        made inside it are sent in bulk when it exits.
+
+        with db.session():
+            for host in db.host.objects().iterate():
+                host.status = 'retired'
+                host.save()
+        """
+        return session.Session(self, chunk_size)
+
+    def submit(self, func, *args, **kwargs):
+        """ Run func(*args, **kwargs) on the worker threads of the db
+        without blocking.  Returns an AsyncResult; get() waits for the
+        value or raises the exception of the call.
+
+        pending = [db.host.aload(i) for i in ids]
+        hosts = [p.get() for p in pending]
+        """
+        with self._async_lock:
+            if self._async_pool is None:
+                self._async_pool = ThreadPool(self.async_workers)
+            pool = self._async_pool
+        return pool.apply_async(func, args, kwargs)
+
+    def close(self):
+        """ Stop the worker threads once the calls in flight are done
+        and close the connections of the http handler
+        """
+        with self._async_lock:
+            pool = self._async_pool
+            self._async_pool = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+        handler = getattr(self.client, '_http_handler', None)
+        if hasattr(handler, 'close'):
+            handler.close()
+
+    def replicate(self, schema_names, path=':memory:', **kwargs):
+        """ Mirror the entities of the schemas into a local sqlite
+        database at path and sync it once.  Queries made with
+        .local() are then answered from it.  Returns the Replica;
+        call its sync() (or start(interval)) to pull changes.
+        """
+        self.replica = replica.Replica(self, schema_names, path, **kwargs)
+        self.replica.sync()
+        return self.replica
 
-        raise AttributeError
+    def current_session(self):
+        return getattr(self._local, 'session', None)
 
     def available_schemas(self):
-        return self._schemas.keys()
+        return self._descriptors.keys()
 
-    def _add_schema(self, s):
+    def _set_descriptor(self, s):
         name = s['name']
-        if name not in self._schemas:
-            self._schemas[name] = schema.create_schema(self, s)
-        else:
-            self._schemas[name].update_schema(s)
+        with self._schema_lock:
+            descriptors = dict(self._descriptors)
+            descriptors[name] = s
+            if name in self._schemas:
+                self._schemas[name]._refresh_schema(s)
+            self._descriptors = descriptors
 
     def update_schema(self, s):
         name = s['name']
-        if name in self._schemas:
-            s = self.client.schemas.update(name, s)
-            self._schemas[name].update_schema(s)
+        if name in self._descriptors:
+            s = self.client.schemas.update(name, s)._result
         else:
-            s = self.client.schemas.create(s)
-            self._schemas[name] = schema.create_schema(self, s)
+            s = self.client.schemas.create(s)._result
+        self._set_descriptor(s)
+
+    def _schema_cache_key(self, opts):
+        return json.dumps({
+            'uri' : getattr(self.client, 'base_uri', None),
+            'opts' : opts
+        }, sort_keys=True)
+
+    def _fetch_schemas_by_name(self, names):
+        fetched = { }
+        for chunk in schema._chunks(names, schema.ID_CHUNK_SIZE):
+            q = { 'q' : { 'name' : { '$in' : chunk } } }
+            for s in self.client.schemas.fetch_all(q):
+                fetched[s['name']] = s
+        return fetched
+
+    def _fetch_schemas(self, opts):
+        if self.schema_cache is None:
+            return list(self.client.schemas.fetch_all(opts))
+
+        key = self._schema_cache_key(opts)
+        cached = self.schema_cache.load(key)
+        if cached is None:
+            schemas = list(self.client.schemas.fetch_all(opts))
+            self.schema_cache.save(key, schemas)
+            return schemas
+
+        # only download the schemas that changed since they were cached
+        q = dict(opts or { })
+        q['fields'] = SCHEMA_VERSION_FIELDS
+        versions = self.client.schemas.fetch_all(q)
+        cached = dict(map(lambda s : (s['name'], s), cached))
+        stale = []
+        for v in versions:
+            s = cached.get(v['name'], None)
+            version = _schema_version(v)
+            if (not s or version == (None, None) or
+                version != _schema_version(s)):
+                stale.append(v['name'])
+
+        fetched = self._fetch_schemas_by_name(stale)
+        schemas = []
+        for v in versions:
+            s = fetched.get(v['name'], None) or cached.get(v['name'], None)
+            if s:
+                schemas.append(s)
+        if stale or len(schemas) != len(cached):
+            self.schema_cache.save(key, schemas)
+        return schemas
+
+    # the schemas changed since the last refresh along with the
+    # unchanged descriptors we already have, or None if a full
+    # refresh is needed
+    def _fetch_updated_schemas(self, opts):
+        if self._schema_watermark is None or opts != self._refresh_opts:
+            return None
+        current = self._descriptors
+
+        path, updated_at = self._schema_watermark
+        q = dict(opts or { })
+        # >= so schemas saved in the same ms as the watermark aren't missed
+        updated_q = { path : { '$gte' : updated_at } }
+        if q.get('q', None):
+            q['q'] = { '$and' : [q['q'], updated_q] }
+        else:
+            q['q'] = updated_q
+        updated = dict(map(lambda s : (s['name'], s),
+                           self.client.schemas.fetch_all(q)))
+
+        # deletions only show up in the list of names
+        q = dict(opts or { })
+        q['fields'] = 'name'
+        names = map(lambda s : s['name'], self.client.schemas.fetch_all(q))
+        missing = filter(lambda n : n not in updated and
+                                    n not in current, names)
+        updated.update(self._fetch_schemas_by_name(missing))
+
+        changed = len(names) != len(current)
+        schemas = []
+        for name in names:
+            curr = current.get(name, None)
+            s = updated.get(name, curr)
+            if s is None:
+                continue
+            if s is not curr and s == curr:
+                s = curr
+            changed = changed or s is not curr
+            schemas.append(s)
+
+        if changed and self.schema_cache is not None:
+            self.schema_cache.save(self._schema_cache_key(opts), schemas)
+        return schemas
 
-    def refresh(self, opts=None):
-        schemas = self.client.schemas.fetch_all(opts)
-        schema_names = set(map(lambda s : s['name'], schemas))
-        my_schemas = set(self._schemas.keys())
+    def refresh(self, opts=None, full=False):
+        """ Fetch the schemas from the server.  After the first refresh
+        only the schemas updated since the newest _updated_at seen are
+        downloaded, unless full is True.
+        """
+        with self._refresh_lock:
+            schemas = None
+            if not full:
+                schemas = self._fetch_updated_schemas(opts)
+            if schemas is None:
+                schemas = self._fetch_schemas(opts)
 
-        deleted_schema_names = my_schemas - schema_names
-        for deleted in deleted_schema_names:
-            self._schemas.pop(deleted, None)
+            descriptors = { }
+            for s in schemas:
+                descriptors[s['name']] = s
 
-        for s in schemas:
-            self._add_schema(s)
+            with self._schema_lock:
+                # update the classes already built in place and drop
+                # the deleted ones
+                built = { }
+                for name, cls in self._schemas.iteritems():
+                    if name in descriptors:
+                        cls._refresh_schema(descriptors[name])
+                        built[name] = cls
+                self._descriptors = descriptors
+                self._schemas = built
+                self._refresh_opts = opts
+                self._schema_watermark = _schema_watermark(schemas)
@@ -0,0 +1,151 @@
+import weakref
+import collections
+import json
+import os
+import threading
+import time
+
+class IdentityMap(object):
+    """Maps (schema name, _id) to the single object loaded for it.
+    Entries are weak references unless max_size is given, in which
+    case the max_size most recently used objects are kept alive.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        if max_size is None:
+            self._objs = weakref.WeakValueDictionary()
+        else:
+            self._objs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._objs)
+
+    def get(self, schema_name, obj_id):
+        key = (schema_name, obj_id)
+        with self._lock:
+            obj = self._objs.get(key, None)
+            if obj is not None and self.max_size is not None:
+                # move to the most recently used end
+                del self._objs[key]
+                self._objs[key] = obj
+        return obj
+
+    def add(self, schema_name, obj_id, obj):
+        key = (schema_name, obj_id)
+        with self._lock:
+            self._objs.pop(key, None)
+            self._objs[key] = obj
+            if self.max_size is not None:
+                while len(self._objs) > self.max_size:
+                    self._objs.popitem(last=False)
+
+    def remove(self, schema_name, obj_id):
+        with self._lock:
+            self._objs.pop((schema_name, obj_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._objs.clear()
+
+
+class QueryCache(object):
+    """Caches raw query results per schema for up to ttl seconds,
+    keeping at most max_size entries (least recently used are evicted).
+    Values are stored serialized so the objects built from a cached
+    result can't modify it.  get_shared decodes a value once and hands
+    the same copy to every caller.
+
+    Any object with the same get / set / invalidate methods can be
+    given to SisDb as its query_cache.
+    """
+
+    def __init__(self, ttl=60, max_size=1000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, schema_name, key):
+        entry_key = (schema_name, key)
+        with self._lock:
+            entry = self._entries.pop(entry_key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                return None
+            self._entries[entry_key] = entry
+        return json.loads(entry[1])
+
+    def get_shared(self, schema_name, key):
+        """ Like get, but the value is only decoded the first time.
+        Callers must not modify it
+        """
+        entry_key = (schema_name, key)
+        with self._lock:
+            entry = self._entries.pop(entry_key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                return None
+            self._entries[entry_key] = entry
+        if entry[2] is None:
+            # a race only decodes it twice
+            entry[2] = json.loads(entry[1])
+        return entry[2]
+
+    def set(self, schema_name, key, value):
+        entry_key = (schema_name, key)
+        value = json.dumps(value)
+        with self._lock:
+            self._entries.pop(entry_key, None)
+            # [expires, serialized value, decoded value]
+            self._entries[entry_key] = [time.time() + self.ttl, value, None]
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, schema_name):
+        with self._lock:
+            for entry_key in self._entries.keys():
+                if entry_key[0] == schema_name:
+                    del self._entries[entry_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class SchemaCache(object):
+    """Keeps the schema descriptors fetched by SisDb.refresh in a local
+    json file.  Later runs only fetch the names and versions of the
+    schemas and download the ones that changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self, key):
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if not isinstance(cached, dict) or cached.get('key', None) != key:
+            return None
+        return cached.get('schemas', None)
+
+    def save(self, key, schemas):
+        # write to a temp file first so readers never see half a file
+        tmp_path = '%s.%d.%d.tmp' % (self.path, os.getpid(),
+                                     threading.current_thread().ident)
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({ 'key' : key, 'schemas' : schemas }, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            # the cache is only an optimization
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -3,15 +3,21 @@
 # https://raw.github.com/MongoEngine/mongoengine/master/mongoengine/base/datastructures.py
 
 import weakref
+import copy
+import itertools
 import schema
 
+def raw_items(l):
+    """ Iterates the values stored in a list without converting
+    or dereferencing them
+    """
+    return list.__iter__(l)
+
 class BaseDict(dict):
     """A special dict so we can watch any changes
     """
 
-    _dereferenced = False
-    _instance = None
-    _name = None
+    __slots__ = ('_instance', '_name')
 
     def __init__(self, dict_items, instance, name):
         if isinstance(instance, weakref.ProxyType):
@@ -25,38 +31,41 @@ class BaseDict(dict):
         value = super(BaseDict, self).__getitem__(*args, **kwargs)
         return value
 
-    def __setitem__(self, *args, **kwargs):
-        self._mark_as_changed()
-        return super(BaseDict, self).__setitem__(*args, **kwargs)
+    def __setitem__(self, key, *args, **kwargs):
+        self._mark_as_changed(key)
+        return super(BaseDict, self).__setitem__(key, *args, **kwargs)
 
     def __delete__(self, *args, **kwargs):
         self._mark_as_changed()
         return super(BaseDict, self).__delete__(*args, **kwargs)
 
-    def __delitem__(self, *args, **kwargs):
-        self._mark_as_changed()
-        return super(BaseDict, self).__delitem__(*args, **kwargs)
+    def __delitem__(self, key, *args, **kwargs):
+        self._mark_as_changed(key)
+        return super(BaseDict, self).__delitem__(key, *args, **kwargs)
 
     def __delattr__(self, *args, **kwargs):
         self._mark_as_changed()
         return super(BaseDict, self).__delattr__(*args, **kwargs)
 
     def __getstate__(self):
-        self.instance = None
-        self._dereferenced = False
         return self
 
     def __setstate__(self, state):
         self = state
         return self
 
+    def __deepcopy__(self, memo):
+        # copies are plain dicts that aren't tied to an instance
+        return copy.deepcopy(dict(self), memo)
+
     def clear(self, *args, **kwargs):
         self._mark_as_changed()
         return super(BaseDict, self).clear(*args, **kwargs)
 
-    def pop(self, *args, **kwargs):
-        self._mark_as_changed()
-        return super(BaseDict, self).pop(*args, **kwargs)
+    def pop(self, key, *args, **kwargs):
+        if key in self:
+            self._mark_as_changed(key)
+        return super(BaseDict, self).pop(key, *args, **kwargs)
 
     def popitem(self, *args, **kwargs):
         self._mark_as_changed()
@@ -66,18 +75,21 @@ class BaseDict(dict):
         self._mark_as_changed()
         return super(BaseDict, self).update(*args, **kwargs)
 
-    def _mark_as_changed(self):
-        if hasattr(self._instance, '_mark_as_changed'):
-            self._instance._mark_as_changed(self._name)
+    # marks the changed key, or the whole dict
+    def _mark_as_changed(self, key=None):
+        instance = getattr(self, '_instance', None)
+        if hasattr(instance, '_mark_as_changed'):
+            if key is None:
+                instance._mark_as_changed(self._name)
+            else:
+                instance._mark_as_changed('%s.%s' % (self._name, key))
 
 
 class BaseList(list):
     """A special list so we can watch any changes
     """
 
-    _dereferenced = False
-    _instance = None
-    _name = None
+    __slots__ = ('_instance', '_name', '_inner_field', '_convert', '_dereferenced')
 
     def __init__(self, list_items, instance, name, inner_field):
         if isinstance(instance, weakref.ProxyType):
@@ -86,6 +98,8 @@ class BaseList(list):
             self._instance = weakref.proxy(instance)
         self._name = name
         self._inner_field = inner_field
+        self._convert = getattr(inner_field, 'convert', None)
+        self._dereferenced = False
         return super(BaseList, self).__init__(list_items)
 
     def __contains__(self, item):
@@ -103,12 +117,34 @@ class BaseList(list):
                     return True
         return False
 
+    # references are only loaded on iteration or slicing when they
+    # can be loaded in a batch.  otherwise only indexing loads them
+    def _lazy(self):
+        batched = getattr(self._inner_field, 'batched', None)
+        return batched is not None and not batched()
+
+    def __iter__(self):
+        if self._lazy():
+            return list.__iter__(self)
+        # go through __getitem__ so references are loaded in a batch
+        return itertools.imap(self.__getitem__, xrange(len(self)))
+
+    def __getslice__(self, i, j):
+        return self.__getitem__(slice(i, j))
+
     def __getitem__(self, index, *args, **kwargs):
+        if isinstance(index, slice):
+            if self._lazy():
+                return list.__getitem__(self, index)
+            return map(self.__getitem__, xrange(*index.indices(len(self))))
+        if not self._dereferenced and hasattr(self._inner_field, 'convertMany'):
+            self._dereference()
         value = super(BaseList, self).__getitem__(index)
-        if hasattr(self._inner_field, 'convert'):
-            new_val = self._inner_field.convert(value, self._instance)
-            if type(new_val) != type(value) or new_val != value:
-                self[index] = new_val
+        if self._convert is not None:
+            new_val = self._convert(value, self._instance)
+            if new_val is not value:
+                # converting isn't a change
+                super(BaseList, self).__setitem__(index, new_val)
                 value = new_val
         return value
 
@@ -129,14 +165,16 @@ class BaseList(list):
         return super(BaseList, self).__delslice__(*args, **kwargs)
 
     def __getstate__(self):
-        self.instance = None
-        self._dereferenced = False
         return self
 
     def __setstate__(self, state):
         self = state
         return self
 
+    def __deepcopy__(self, memo):
+        # copies are plain lists that aren't tied to an instance
+        return copy.deepcopy(list(raw_items(self)), memo)
+
     def append(self, *args, **kwargs):
         self._mark_as_changed()
         return super(BaseList, self).append(*args, **kwargs)
@@ -165,6 +203,15 @@ class BaseList(list):
         self._mark_as_changed()
         return super(BaseList, self).sort(*args, **kwargs)
 
+    def _dereference(self):
+        # convert all the items at once on first access so
+        # references can be loaded in a single batch
+        self._dereferenced = True
+        vals = self._inner_field.convertMany(list(raw_items(self)), self._instance)
+        for i, v in enumerate(vals):
+            super(BaseList, self).__setitem__(i, v)
+
     def _mark_as_changed(self, name=None):
-        if hasattr(self._instance, '_mark_as_changed'):
-            self._instance._mark_as_changed(self._name)
+        instance = getattr(self, '_instance', None)
+        if hasattr(instance, '_mark_as_changed'):
+            instance._mark_as_changed(self._name)
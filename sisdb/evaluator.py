@@ -0,0 +1,260 @@
+""" Evaluates the mongo style queries of Query.filter against raw
+items held locally (a Replica or a cached scan) instead of on the
+server.  Supports equality, $in, $nin, $gt, $gte, $lt, $lte, $ne,
+$exists, $regex, $size, $not, $and, $or and $nor on dotted paths,
+with arrays matching when any element does.  Anything else raises
+SisEvaluatorError (validate checks a query up front) so the caller can
+ask the server instead.
+"""
+import re
+
+class SisEvaluatorError(Exception):
+    def __init__(self, value, *args, **kwargs):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+_MISSING = object()
+
+# operators of a field condition
+_OPERATORS = set(['$eq', '$ne', '$in', '$nin', '$gt', '$gte', '$lt', '$lte',
+                  '$exists', '$regex', '$options', '$size', '$not'])
+
+# operators combining queries
+_LOGICAL = set(['$and', '$or', '$nor'])
+
+# value at a dotted path of an item or _MISSING
+def get_path(item, path):
+    val = item
+    for p in path.split('.'):
+        if not isinstance(val, dict) or p not in val:
+            return _MISSING
+        val = val[p]
+    return val
+
+# every value a dotted path reaches, descending into arrays of
+# objects the way mongo does.  empty if the path doesn't exist
+def _path_values(val, parts):
+    if not parts:
+        return [val]
+    if isinstance(val, dict):
+        if parts[0] not in val:
+            return []
+        return _path_values(val[parts[0]], parts[1:])
+    if isinstance(val, list):
+        result = []
+        for v in val:
+            if isinstance(v, dict):
+                result.extend(_path_values(v, parts))
+        return result
+    return []
+
+def _is_number(val):
+    return isinstance(val, (int, long, float)) and not isinstance(val, bool)
+
+def _equals_one(val, expected):
+    if val == expected:
+        return True
+    # populated references compare by their _id
+    return (isinstance(val, dict) and isinstance(expected, basestring) and
+            val.get('_id', None) == expected)
+
+def _equals(val, expected):
+    if _equals_one(val, expected):
+        return True
+    # arrays match if any element does
+    return isinstance(val, list) and any(map(lambda v : _equals_one(v, expected), val))
+
+def _compare(val, expected, op):
+    # only values of the same kind are compared
+    if _is_number(val) and _is_number(expected):
+        pass
+    elif isinstance(val, basestring) and isinstance(expected, basestring):
+        pass
+    elif isinstance(val, bool) and isinstance(expected, bool):
+        pass
+    else:
+        return False
+    if op == '$gt':
+        return val > expected
+    elif op == '$gte':
+        return val >= expected
+    elif op == '$lt':
+        return val < expected
+    return val <= expected
+
+def _regex(expected, options):
+    flags = 0
+    for o in options or '':
+        flags |= { 'i' : re.I, 'm' : re.M, 's' : re.S, 'x' : re.X }.get(o, 0)
+    return re.compile(expected, flags)
+
+# true if any of the values (or their elements) match the condition
+def _any(values, cond):
+    for val in values:
+        if cond(val):
+            return True
+        if isinstance(val, list) and any(map(cond, val)):
+            return True
+    return False
+
+def _match_eq(values, expected):
+    if expected is None and not values:
+        # a missing field is equal to null
+        return True
+    return any(map(lambda v : _equals(v, expected), values))
+
+def _match_ops(values, ops):
+    for op, expected in ops.iteritems():
+        if op == '$eq':
+            ok = _match_eq(values, expected)
+        elif op == '$ne':
+            ok = not _match_eq(values, expected)
+        elif op == '$in':
+            ok = any(map(lambda e : _match_eq(values, e), expected))
+        elif op == '$nin':
+            ok = not any(map(lambda e : _match_eq(values, e), expected))
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            ok = _any(values, lambda v : _compare(v, expected, op))
+        elif op == '$exists':
+            ok = bool(values) == bool(expected)
+        elif op == '$regex':
+            regex = _regex(expected, ops.get('$options', None))
+            ok = _any(values, lambda v : isinstance(v, basestring) and
+                                         regex.search(v) is not None)
+        elif op == '$options':
+            ok = True
+        elif op == '$size':
+            ok = any(map(lambda v : isinstance(v, list) and len(v) == expected, values))
+        elif op == '$not':
+            ok = not _match_cond(values, expected)
+        else:
+            raise SisEvaluatorError("Unsupported operator: %s" % op)
+        if not ok:
+            return False
+    return True
+
+def _is_ops(cond):
+    return (isinstance(cond, dict) and len(cond) > 0 and
+            all(map(lambda k : k.startswith('$'), cond)))
+
+def _match_cond(values, cond):
+    if _is_ops(cond):
+        return _match_ops(values, cond)
+    return _match_eq(values, cond)
+
+def _validate_cond(cond):
+    if not _is_ops(cond):
+        return
+    for op, expected in cond.iteritems():
+        if op not in _OPERATORS:
+            raise SisEvaluatorError("Unsupported operator: %s" % op)
+        if op == '$not':
+            _validate_cond(expected)
+
+def validate(q):
+    """ Raise SisEvaluatorError if matches can't evaluate the query q """
+    for key, cond in (q or { }).iteritems():
+        if key in _LOGICAL:
+            for sub in cond:
+                validate(sub)
+        elif key.startswith('$'):
+            raise SisEvaluatorError("Unsupported operator: %s" % key)
+        else:
+            _validate_cond(cond)
+
+def matches(item, q):
+    """ True if item matches the query q """
+    if not q:
+        return True
+    for key, cond in q.iteritems():
+        if key == '$and':
+            ok = all(map(lambda sub : matches(item, sub), cond))
+        elif key == '$or':
+            ok = any(map(lambda sub : matches(item, sub), cond))
+        elif key == '$nor':
+            ok = not any(map(lambda sub : matches(item, sub), cond))
+        elif key.startswith('$'):
+            raise SisEvaluatorError("Unsupported operator: %s" % key)
+        else:
+            ok = _match_cond(_path_values(item, key.split('.')), cond)
+        if not ok:
+            return False
+    return True
+
+def parse_sort(sort):
+    """ [(path, descending)] from 'name,-age' or ['name', '-age'] """
+    if not sort:
+        return []
+    if isinstance(sort, basestring):
+        sort = sort.split(',')
+    return map(lambda s : (s[1:], True) if s.startswith('-') else (s, False), sort)
+
+# mongo orders values of different types by type first
+def _sort_rank(val):
+    if val is None or val is _MISSING:
+        return (0, None)
+    if _is_number(val):
+        return (1, val)
+    if isinstance(val, basestring):
+        return (2, val)
+    if isinstance(val, dict):
+        return (3, val)
+    if isinstance(val, bool):
+        return (5, val)
+    return (4, val)
+
+def _sort_key(item, path, descending):
+    val = get_path(item, path)
+    if isinstance(val, list):
+        if not val:
+            # empty arrays sort before null
+            return (-1, None)
+        # arrays sort by their smallest element, or their
+        # largest when descending
+        ranks = map(_sort_rank, val)
+        return max(ranks) if descending else min(ranks)
+    return _sort_rank(val)
+
+def sort_items(items, sort):
+    """ Sort items in place by the sort keys.  Missing values sort first """
+    # python sorts are stable so sort by the last key first
+    for path, descending in reversed(parse_sort(sort)):
+        items.sort(key=lambda item : _sort_key(item, path, descending),
+                   reverse=descending)
+    return items
+
+def project(item, fields):
+    """ Copy of item with only _id and the (dotted) fields """
+    result = { }
+    for path in ['_id'] + list(fields):
+        val = get_path(item, path)
+        if val is _MISSING:
+            continue
+        parts = path.split('.')
+        dest = result
+        for p in parts[:-1]:
+            dest = dest.setdefault(p, { })
+        dest[parts[-1]] = val
+    return result
+
+def fetch_page(items, q):
+    """ (items, total_count) of a fetch_page request q
+    ({ 'q', 'sort', 'offset', 'limit', 'fields' }) run over items
+    """
+    items = filter(lambda item : matches(item, q.get('q', None)), items)
+    sort_items(items, q.get('sort', None))
+    total = len(items)
+    offset = q.get('offset', None) or 0
+    limit = q.get('limit', None)
+    if limit is None:
+        items = items[offset:]
+    else:
+        items = items[offset:offset + limit]
+    if q.get('fields', None):
+        fields = q['fields']
+        if isinstance(fields, basestring):
+            fields = fields.split(',')
+        items = map(lambda item : project(item, fields), items)
+    return (items, total)
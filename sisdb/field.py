@@ -2,6 +2,9 @@ import schema
 import datastructures
 import datetime
 
+# most fields a db keeps for reuse
+FIELD_CACHE_SIZE = 10000
+
 class SisFieldError(Exception):
     def __init__(self, value, *args, **kwargs):
         self.value = value
@@ -21,19 +24,28 @@ class SisField(object):
     def __get__(self, instance, owner):
         if instance is None:
             return self
+        # values are converted on the first read and then
+        # read straight from the data until they are set again
+        if self.name in instance._clean:
+            return instance._data.get(self.name, None)
         res = instance._data.get(self.name, None)
-        if hasattr(self, 'to_sis_value'):
-            sis_res = self.to_sis_value(res)
-            if res != sis_res:
-                res = sis_res
-                instance._data[self.name] = res
-        return res
+        sis_res = self.normalize(res, instance)
+        if sis_res is not res:
+            instance._data[self.name] = sis_res
+        instance._clean.add(self.name)
+        return sis_res
 
     def __set__(self, instance, value):
         if (self.name not in instance._data or
             instance._data[self.name] != value):
                 instance._mark_as_changed(self.name)
                 instance._data[self.name] = value
+                instance._clean.discard(self.name)
+
+    def normalize(self, value, instance):
+        if hasattr(self, 'to_sis_value'):
+            return self.to_sis_value(value)
+        return value
 
     def raise_error(self, msg):
         raise SisFieldError(msg)
@@ -64,7 +76,7 @@ class DateField(SisField):
         if (type(value) in [str, unicode]):
             # parse to datetime
             try:
-                value = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+                value = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
                 return value
             except:
                 print "value : " + unicode(type(value))
@@ -103,22 +115,12 @@ class MixedField(SisField):
     def __init__(self, field_descriptor, *args, **kwargs):
         super(MixedField, self).__init__(field_descriptor, *args, **kwargs)
 
-    def __get__(self, instance, owner):
-        if instance is None:
-            return self
-        mix = instance._data.get(self.name, None)
-        if not mix or not isinstance(mix, dict):
-            instance._data[self.name] = datastructures.BaseDict({}, instance, self.name)
-        elif not isinstance(mix, datastructures.BaseDict):
-            instance._data[self.name] = datastructures.BaseDict(mix, instance, self.name)
-
-        return instance._data[self.name]
-
-    def __set__(self, instance, value):
-        if (self.name not in instance._data or
-            instance._data[self.name] != value):
-                instance._mark_as_changed(self.name)
-                instance._data[self.name] = value
+    def normalize(self, mix, instance):
+        if isinstance(mix, datastructures.BaseDict):
+            return mix
+        elif not mix or not isinstance(mix, dict):
+            return datastructures.BaseDict({}, instance, self.name)
+        return datastructures.BaseDict(mix, instance, self.name)
 
 class ListField(SisField):
     def __init__(self, field_descriptor, *args, **kwargs):
@@ -141,33 +143,23 @@ class ListField(SisField):
         else:
             return listvalue
 
-    def __get__(self, instance, owner):
-        if instance is None:
-            return self
-        listvalue = instance._data.get(self.name, None)
-        listvalue = self.convert(listvalue, instance)
-        instance._data[self.name] = listvalue
-        return instance._data[self.name]
+    def normalize(self, listvalue, instance):
+        return self.convert(listvalue, instance)
 
     def __set__(self, instance, value):
         if (self.name not in instance._data or
             instance._data[self.name] != value):
                 instance._mark_as_changed(self.name)
                 instance._data[self.name] = self.convert(value, instance)
+                instance._clean.add(self.name)
 
 class ObjectIdField(SisField):
     def __init__(self, field_descriptor, *args, **kwargs):
         super(ObjectIdField, self).__init__(field_descriptor, *args, **kwargs)
         self.sisdb = kwargs.get('sisdb')
 
-    def __get__(self, instance, owner):
-        if instance is None:
-            return self
-        val = instance._data.get(self.name, None)
-        val = self.convert(val, instance)
-        instance._data[self.name] = val
-
-        return instance._data[self.name]
+    def normalize(self, val, instance):
+        return self.convert(val, instance)
 
     def to_str(self, value):
         if isinstance(value, str) or isinstance(value, unicode):
@@ -190,21 +182,48 @@ class ObjectIdField(SisField):
     def convertLazy(self, val, instance):
         return self._convertHelper(val, instance, True)
 
+    # whether lists of these load their references in one batch
+    def batched(self):
+        return bool(getattr(self.sisdb, 'batch_dereference', False))
+
+    def convertMany(self, vals, instance):
+        # only batch when asked to - otherwise items are
+        # loaded one at a time as they are read
+        if not self.batched():
+            return vals
+
+        # load all the ids in one go
+        ref_cls = self.get_ref_cls()
+        if not ref_cls:
+            return vals
+        vals = map(lambda v: self.convertLazy(v, instance), vals)
+        ids = filter(_is_id_str, vals)
+        if len(ids) == 0:
+            return vals
+        loaded = ref_cls.load_many(ids)
+        return map(lambda v: loaded.get(v, v) if _is_id_str(v) else v, vals)
+
+    def get_ref_cls(self):
+        # check if the object id is a ref..
+        ref_type = self.field_desc.get('ref', None)
+        if not ref_type:
+            return None
+        return getattr(self.sisdb, ref_type)
+
     def _convertHelper(self, val, instance, lazy):
         if not val:
             # nothin
             return val
 
-        # check if the object id is a ref..
-        ref_type = self.field_desc.get('ref', None)
-        if not ref_type:
-            # not a ref.. just return
+        if isinstance(val, schema.SisSchema):
+            # already an object
             return val
 
         # we have a ref.. let's see if it's an object id that needs
         # to load, a dictionary that needs to be converted, or the object itself
-        ref_cls = getattr(self.sisdb, ref_type)
+        ref_cls = self.get_ref_cls()
         if not ref_cls:
+            # not a ref.. just return
             return val
 
         if isinstance(val, ref_cls):
@@ -212,19 +231,13 @@ class ObjectIdField(SisField):
             return val
         elif isinstance(val, dict):
             # convert to schema
-            val = ref_cls(data=val, from_server=True)
+            val = ref_cls.from_server(val)
         elif isinstance(val, str) or isinstance(val, unicode):
             if not lazy:
                 val = ref_cls.load(val)
 
         return val
 
-    def __set__(self, instance, value):
-        if (self.name not in instance._data or
-            instance._data[self.name] != value):
-                instance._mark_as_changed(self.name)
-                instance._data[self.name] = value
-
 class EmbeddedSchemaField(SisField):
     def __init__(self, schema_desc, *args, **kwargs):
         super(EmbeddedSchemaField, self).__init__(schema_desc, *args, **kwargs)
@@ -233,20 +246,8 @@ class EmbeddedSchemaField(SisField):
         e_name = kwargs.get('e_name')
         self.schema_cls = schema.create_embedded_schema(sisdb, schema_desc, e_name)
 
-    def __get__(self, instance, owner):
-        if instance is None:
-            return self
-
-        value = instance._data.get(self.name, None)
-        value = self.convert(value, instance)
-        instance._data[self.name] = value
-        return value
-
-    def __set__(self, instance, value):
-        if (self.name not in instance._data or
-            instance._data[self.name] != value):
-                instance._mark_as_changed(self.name)
-                instance._data[self.name] = value
+    def normalize(self, value, instance):
+        return self.convert(value, instance)
 
     def convert(self, value, instance):
         if not value:
@@ -259,30 +260,127 @@ class EmbeddedSchemaField(SisField):
                 # don't mark as changed.
                 vals_dict = value
                 value = self.schema_cls(instance, self.name)
+                value._initialized = False
                 value.set_data(vals_dict)
+                value._initialized = True
             else:
                 value = self.schema_cls(instance, self.name)
         return value
 
 
-def create_field_from_string(descriptor, name, sisdb):
-    field_types = {
-        'number' : NumberField,
-        'boolean' : BooleanField,
-        'string' : StringField,
-        'objectid' : ObjectIdField,
-        'ipaddress' : MixedField,
-        'mixed' : MixedField,
-        'date' : DateField,
-    }
+def _is_id_str(val):
+    return isinstance(val, str) or isinstance(val, unicode)
+
+def dereference(instances):
+    """ Resolve the string ids held by the ObjectId fields (and lists
+    of ObjectIds) of instances using one batched $in query per referenced
+    schema instead of a load per id.
+    """
+    if not instances:
+        return instances
+
+    cls = instances[0].__class__
+    ref_fields = []
+    for k in cls.defn.keys():
+        f = getattr(cls, k, None)
+        if isinstance(f, ListField):
+            inner = f._inner_field
+            if isinstance(inner, ObjectIdField) and inner.get_ref_cls():
+                ref_fields.append((f.name, inner.get_ref_cls(), True))
+        elif isinstance(f, ObjectIdField) and f.get_ref_cls():
+            ref_fields.append((f.name, f.get_ref_cls(), False))
+
+    if len(ref_fields) == 0:
+        return instances
+
+    # gather the unresolved ids for each referenced schema
+    ids = { }
+    for inst in instances:
+        for name, ref_cls, is_list in ref_fields:
+            val = inst._data.get(name, None)
+            if is_list and isinstance(val, list):
+                ids.setdefault(ref_cls, set()).update(
+                    filter(_is_id_str, datastructures.raw_items(val)))
+            elif _is_id_str(val):
+                ids.setdefault(ref_cls, set()).add(val)
+
+    loaded = { }
+    for ref_cls, ref_ids in ids.iteritems():
+        loaded[ref_cls] = ref_cls.load_many(ref_ids)
+
+    # fill them in without marking anything as changed
+    for inst in instances:
+        for name, ref_cls, is_list in ref_fields:
+            objs = loaded.get(ref_cls, None)
+            if not objs:
+                continue
+            val = inst._data.get(name, None)
+            if is_list and isinstance(val, list):
+                for i, v in enumerate(datastructures.raw_items(val)):
+                    if _is_id_str(v) and v in objs:
+                        list.__setitem__(val, i, objs[v])
+            elif _is_id_str(val) and val in objs:
+                inst._data[name] = objs[val]
+
+    return instances
+
+
+FIELD_TYPES = {
+    'number' : NumberField,
+    'boolean' : BooleanField,
+    'string' : StringField,
+    'objectid' : ObjectIdField,
+    'ipaddress' : MixedField,
+    'mixed' : MixedField,
+    'date' : DateField,
+}
+
+# true if the field of a descriptor holds no embedded schema.
+# those don't depend on the schema they're in so they can be shared
+def _is_scalar(descriptor):
+    if isinstance(descriptor, basestring):
+        return True
+    if isinstance(descriptor, list):
+        return len(descriptor) == 0 or _is_scalar(descriptor[0])
+    if isinstance(descriptor, dict):
+        desc_type = descriptor.get('type', None)
+        if len(descriptor) == 0 or isinstance(desc_type, basestring):
+            return True
+        return isinstance(desc_type, list) and _is_scalar(desc_type)
+    return False
+
+# a hashable copy of a json descriptor
+def _frozen(val):
+    if isinstance(val, dict):
+        return (dict, tuple(sorted(map(lambda (k, v) : (k, _frozen(v)), val.iteritems()))))
+    if isinstance(val, list):
+        return (list, tuple(map(_frozen, val)))
+    return val
+
+# scalar fields built for a db keyed by their descriptor and name so
+# schemas with the same fields share them.  the least recently used
+# are dropped past FIELD_CACHE_SIZE
+def _cached(sisdb, key, build):
+    cache = getattr(sisdb, '_field_cache', None)
+    if cache is None:
+        return build()
+    with sisdb._schema_lock:
+        result = cache.pop(key, None)
+        if result is None:
+            result = build()
+        cache[key] = result
+        while len(cache) > FIELD_CACHE_SIZE:
+            cache.popitem(last=False)
+    return result
 
+def create_field_from_string(descriptor, name, sisdb):
     if (type(descriptor) == unicode or
         type(descriptor) == str):
         stype = unicode(descriptor).lower()
-        if stype not in field_types:
+        if stype not in FIELD_TYPES:
             raise SisFieldError('Unknown type: %s Field: %s' % (descriptor, name))
 
-        result = field_types[stype]({ 'type' : stype }, sisdb=sisdb)
+        result = FIELD_TYPES[stype]({ 'type' : stype }, sisdb=sisdb)
         result.name = name
         return result
 
@@ -290,6 +388,14 @@ def create_field_from_string(descriptor, name, sisdb):
 
 
 def create_field(descriptor, name, sisdb, schema_name):
+    if not _is_scalar(descriptor):
+        # embedded schema classes are named after the schema
+        # and field so each owner builds its own
+        return _create_field(descriptor, name, sisdb, schema_name)
+    key = (_frozen(descriptor), name)
+    return _cached(sisdb, key, lambda: _create_field(descriptor, name, sisdb, schema_name))
+
+def _create_field(descriptor, name, sisdb, schema_name):
     result = create_field_from_string(descriptor, name, sisdb)
 
     if result:
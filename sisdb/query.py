@@ -1,3 +1,82 @@
+import evaluator
+import field
+import schema
+import util
+import array
+import calendar
+import copy
+import datetime
+import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# default number of items requested per page
+PAGE_SIZE = 200
+
+# value at a dotted path of a raw item, or None
+def _get_path(item, path):
+    val = item
+    for p in path.split('.'):
+        if not isinstance(val, dict):
+            return None
+        val = val.get(p, None)
+    return val
+
+# type name ('number', 'boolean', ...) of a dotted path
+# in a schema definition or None if it isn't a simple type
+def _path_type(defn, path):
+    desc = defn
+    for p in path.split('.'):
+        if isinstance(desc, dict) and isinstance(desc.get('type', None), dict):
+            desc = desc['type']
+        if not isinstance(desc, dict) or p not in desc:
+            return None
+        desc = desc[p]
+    if isinstance(desc, dict):
+        desc = desc.get('type', None)
+    if isinstance(desc, basestring):
+        return desc.lower()
+    return None
+
+def _to_number(val):
+    try:
+        return float(val)
+    except (ValueError, TypeError):
+        return _NAN
+
+# booleans are stored as 1 / 0, with -1 when missing
+_MISSING_BOOL = -1
+
+def _to_bool(val):
+    if val in (True, 'true', 'True'):
+        return 1
+    if val in (False, 'false', 'False'):
+        return 0
+    return _MISSING_BOOL
+
+def _to_timestamp(val):
+    # seconds since the epoch
+    if isinstance(val, basestring):
+        try:
+            val = datetime.datetime.strptime(val, '%Y-%m-%dT%H:%M:%S.%fZ')
+        except ValueError:
+            return _NAN
+    if isinstance(val, datetime.datetime):
+        return calendar.timegm(val.utctimetuple()) + val.microsecond / 1e6
+    return _NAN
+
+_NAN = float('nan')
+
+# array typecode, converter and numpy dtype for each column type
+_COLUMN_TYPES = {
+    'number' : ('d', _to_number, 'f8'),
+    'boolean' : ('b', _to_bool, 'i1'),
+    'date' : ('d', _to_timestamp, 'f8'),
+}
+
 class SisQueryError(Exception):
     def __init__(self, value, *args, **kwargs):
         self.value = value
@@ -17,6 +96,13 @@ class Query(object):
         self._count = -1
         self._is_all = False
         self._populate = True
+        self._dereference = None
+        self._fetch_workers = None
+        self._page_size = PAGE_SIZE
+        self._keyset = False
+        self._read_local = False
+        self._fields = None
+        self._values = None
 
     def _clear_cached_result(self):
         self._result = None
@@ -83,17 +169,500 @@ class Query(object):
         self._clear_cached_result()
         return self
 
+    # batch load the referenced objects of each result set.
+    # defaults to the batch_dereference setting of the SisDb
+    def dereference(self, deref):
+        self._dereference = deref
+        self._clear_cached_result()
+        return self
+
+    # fetch the pages of all_items using up to max_workers
+    # concurrent requests.  defaults to the fetch_workers setting
+    # of the SisDb
+    def parallel(self, max_workers, page_size=PAGE_SIZE):
+        self._fetch_workers = max_workers
+        self._page_size = page_size
+        self._clear_cached_result()
+        return self
+
+    # answer the query from the replica of the db instead of the
+    # server.  see SisDb.replicate.  replicated entities aren't
+    # populated so references are ids, loaded from the server when read
+    def local(self, enabled=True):
+        self._read_local = enabled
+        self._clear_cached_result()
+        return self
+
+    def _replica(self):
+        replica = getattr(self.cls.db, 'replica', None)
+        name = self.cls.descriptor['name']
+        if replica is None or name not in replica:
+            raise SisQueryError("%s is not replicated" % name)
+        return replica
+
+    # page by filtering on the sort keys (and _id) of the last row
+    # seen instead of by offset, so deep pages cost the same as the
+    # first and rows inserted during the scan don't shift the pages.
+    # used by all_items, iterate and to_columns.  every row should
+    # have a value for the sort keys
+    def keyset(self, page_size=PAGE_SIZE):
+        self._keyset = True
+        self._page_size = page_size
+        self._clear_cached_result()
+        return self
+
+    # only ask the server for these fields.  pass in a list
+    # ['name', '_sis._updated_at'] or None for whole documents.
+    # the objects returned are partial and are never put in
+    # the identity map
+    def fields(self, field_list):
+        if field_list is not None:
+            field_list = list(field_list)
+        self._fields = field_list
+        self._clear_cached_result()
+        return self
+
+    # return plain dicts instead of objects.  when field names are
+    # given only those fields are fetched and returned, keyed by name
+    def values(self, *fields):
+        if fields:
+            self.fields(fields)
+        self._values = (fields, dict)
+        self._clear_cached_result()
+        return self
+
+    # return tuples of the field values in order instead of objects,
+    # or just the values when flat is True and there is one field
+    def values_list(self, *fields, **kwargs):
+        if not fields:
+            raise SisQueryError("values_list needs at least one field")
+        flat = kwargs.get('flat', False)
+        if flat and len(fields) != 1:
+            raise SisQueryError("flat values_list needs exactly one field")
+        self.fields(fields)
+        self._values = (fields, 'flat' if flat else tuple)
+        self._clear_cached_result()
+        return self
+
+    def _item_values(self, item):
+        fields, kind = self._values
+        if not fields:
+            return item
+        values = map(lambda f: _get_path(item, f), fields)
+        if kind == dict:
+            return dict(zip(fields, values))
+        elif kind == tuple:
+            return tuple(values)
+        return values[0]
+
+    def to_columns(self, fields, use_numpy=None, page_size=PAGE_SIZE):
+        """ Fetch the fields of every match into one column per field,
+        returned as a dict keyed by field name.  Number, Boolean and Date
+        fields (and _sis._updated_at etc.) are filled into typed
+        array.array buffers straight from the raw pages - doubles with NaN
+        for missing values, bytes of 1 / 0 with -1 for missing values, and
+        seconds since the epoch.  Anything else is a list of the raw values.
+
+        With numpy available (or use_numpy=True) the columns are numpy
+        arrays instead, and Boolean columns are bool masked arrays with
+        the missing values masked.
+        """
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        elif use_numpy and numpy is None:
+            raise SisQueryError("numpy is not installed")
+        fields = list(fields)
+        if not fields:
+            raise SisQueryError("to_columns needs at least one field")
+
+        defn = dict(schema.SIS_INTERNAL_FIELDS)
+        defn.update(self.cls.defn)
+        columns = []
+        for f in fields:
+            col_type = _COLUMN_TYPES.get(_path_type(defn, f), None)
+            if col_type:
+                columns.append((f, array.array(col_type[0]), col_type[1]))
+            else:
+                columns.append((f, [], None))
+
+        q = self._clone().fields(fields)
+        for items in q._iter_pages(page_size):
+            for name, col, convert in columns:
+                if '.' in name:
+                    vals = [_get_path(item, name) for item in items]
+                else:
+                    vals = [item.get(name, None) for item in items]
+                if convert:
+                    vals = map(convert, vals)
+                col.extend(vals)
+
+        result = { }
+        for name, col, convert in columns:
+            if use_numpy:
+                if isinstance(col, array.array):
+                    col_type = _path_type(defn, name)
+                    dtype = _COLUMN_TYPES[col_type][2]
+                    if len(col):
+                        col = numpy.frombuffer(col, dtype=dtype)
+                    else:
+                        col = numpy.array([], dtype=dtype)
+                    if col_type == 'boolean':
+                        col = numpy.ma.masked_array(col == 1, mask=(col == _MISSING_BOOL))
+                else:
+                    col = numpy.array(col, dtype=object)
+            result[name] = col
+        return result
+
+    def _wrap_items(self, items):
+        if self._values is not None:
+            return map(self._item_values, items)
+        if self._fields is not None:
+            # partial objects stay out of the identity map
+            result = map(lambda o : self.cls(data=o, from_server=True), items)
+        else:
+            result = map(self.cls.from_server, items)
+        deref = self._dereference
+        if deref is None:
+            deref = getattr(self.cls.db, 'batch_dereference', False)
+        if deref:
+            field.dereference(result)
+        return result
+
+    def _base_query(self):
+        q = { }
+        if self.query_obj:
+            q['q'] = self.query_obj
+        if self.sort_list:
+            q['sort'] = ','.join(self.sort_list)
+        if not self._populate:
+            q['populate'] = False
+        if self._fields is not None:
+            q['fields'] = ','.join(self._fields)
+        return q
+
+    def _cache_key(self, kind, q):
+        return json.dumps({ 'kind' : kind, 'query' : q }, sort_keys=True)
+
+    # returns the (items, total_count) of a page, consulting
+    # the query cache of the db when there is one
+    def _fetch_page(self, q):
+        if self._read_local:
+            return self._replica().fetch_page(self.cls.descriptor['name'], q)
+
+        query_cache = getattr(self.cls.db, 'query_cache', None)
+        if query_cache is not None:
+            name = self.cls.descriptor['name']
+            key = self._cache_key('page', q)
+            cached = query_cache.get(name, key)
+            if cached is not None:
+                return cached
+            cached = self._from_cached_scan(query_cache, q)
+            if cached is not None:
+                return cached
+
+        def fetch():
+            resp = self.endpoint.fetch_page(q)
+            return (list(resp), resp._meta.total_count)
+        result = self.cls._coalesce(('page', self._cache_key('page', q)), fetch)
+        if query_cache is not None:
+            query_cache.set(name, key, result)
+        return result
+
+    # answer q from a cached scan of the whole schema when there is
+    # one, without asking the server.  None when there isn't or the
+    # query can't be evaluated locally
+    def _from_cached_scan(self, query_cache, q):
+        scan_q = { }
+        if 'populate' in q:
+            scan_q['populate'] = q['populate']
+        if q == scan_q:
+            return None
+        try:
+            evaluator.validate(q.get('q', None))
+        except evaluator.SisEvaluatorError:
+            return None
+        # the scan is decoded once and shared when the cache allows it
+        get = getattr(query_cache, 'get_shared', query_cache.get)
+        cached = get(self.cls.descriptor['name'], self._cache_key('all', scan_q))
+        if cached is None:
+            return None
+        items, total = evaluator.fetch_page(cached[0], q)
+        return (copy.deepcopy(items), total)
+
+    def _fetch_all(self, q):
+        if self._read_local:
+            return self._replica().fetch_page(self.cls.descriptor['name'], q)[0]
+
+        query_cache = getattr(self.cls.db, 'query_cache', None)
+        if query_cache is not None:
+            name = self.cls.descriptor['name']
+            key = self._cache_key('all', q)
+            cached = query_cache.get(name, key)
+            if cached is not None:
+                return cached[0]
+            cached = self._from_cached_scan(query_cache, q)
+            if cached is not None:
+                return cached[0]
+
+        max_workers = self._fetch_workers
+        if max_workers is None:
+            max_workers = getattr(self.cls.db, 'fetch_workers', 1)
+        if max_workers > 1:
+            items = self._fetch_all_parallel(dict(q), max_workers)
+        else:
+            fetch = lambda: list(self.endpoint.fetch_all(dict(q)))
+            items = self.cls._coalesce(('all', self._cache_key('all', q)), fetch)
+
+        if query_cache is not None:
+            query_cache.set(name, key, (items, len(items)))
+        return items
+
+    # (path, operator) of each key the keyset pages are ordered by
+    def _keyset_keys(self):
+        sort = list(self.sort_list or [])
+        if '_id' not in sort and '-_id' not in sort:
+            # unique tie breaker
+            sort.append('_id')
+        return map(lambda s : (s[1:], '$lt') if s.startswith('-') else (s, '$gt'), sort)
+
+    # filter for the rows that sort after item
+    def _keyset_after(self, keys, item):
+        clauses = []
+        for i, (path, op) in enumerate(keys):
+            clause = { }
+            for prev_path, _ in keys[:i]:
+                clause[prev_path] = _get_path(item, prev_path)
+            clause[path] = { op : _get_path(item, path) }
+            clauses.append(clause)
+        if len(clauses) == 1:
+            return clauses[0]
+        return { '$or' : clauses }
+
+    def _iter_keyset_pages(self, page_size, offset=None, limit=None):
+        keys = self._keyset_keys()
+        q = self._base_query()
+        q['sort'] = ','.join(map(lambda k : k[0] if k[1] == '$gt' else '-' + k[0], keys))
+        if self._fields is not None:
+            fields = list(self._fields)
+            fields.extend(filter(lambda p : p not in fields, map(lambda k : k[0], keys)))
+            q['fields'] = ','.join(fields)
+
+        remaining = limit
+        # rows up to the end of the current page
+        seen = offset or 0
+        after = None
+        while remaining is None or remaining > 0:
+            limit = page_size
+            if remaining is not None:
+                limit = min(page_size, remaining)
+            page_q = dict(q)
+            page_q['limit'] = limit
+            if after is None:
+                if offset:
+                    page_q['offset'] = offset
+                items, self._count = self._fetch_page(page_q)
+            else:
+                if self.query_obj:
+                    page_q['q'] = { '$and' : [self.query_obj, after] }
+                else:
+                    page_q['q'] = after
+                # the total of these is only what's left
+                items = self._fetch_page(page_q)[0]
+            if len(items) == 0:
+                return
+
+            yield items
+
+            seen += len(items)
+            if remaining is not None:
+                remaining -= len(items)
+            # a short page is only the end once the rows counted by the
+            # first page are all seen - the server may cap the page size
+            if len(items) < limit and self._count is not None and seen >= self._count:
+                return
+            after = self._keyset_after(keys, items[-1])
+
+    # yields the raw items a page at a time, honoring
+    # the offset and limit of the query
+    def _iter_pages(self, page_size):
+        if self._keyset:
+            for items in self._iter_keyset_pages(page_size, self._offset, self._limit):
+                yield items
+            return
+
+        q = self._base_query()
+        offset = 0 if self._offset is None else self._offset
+        remaining = self._limit
+        while remaining is None or remaining > 0:
+            limit = page_size
+            if remaining is not None:
+                limit = min(page_size, remaining)
+            q['limit'] = limit
+            q['offset'] = offset
+
+            items, self._count = self._fetch_page(q)
+            if len(items) == 0:
+                return
+
+            yield items
+
+            offset += len(items)
+            if remaining is not None:
+                remaining -= len(items)
+            # a short page doesn't mean the end - the server
+            # may cap the page size
+            if self._count is not None and offset >= self._count:
+                return
+
+    def _fetch_all_parallel(self, q, max_workers):
+        # the first page tells us how many more there are
+        q['limit'] = self._page_size
+        q['offset'] = 0
+        items, total = self._fetch_page(q)
+        items = list(items)
+        if len(items) == 0 or len(items) >= total:
+            return items
+
+        # step by what the server actually returned in case
+        # it caps the page size
+        def fetch(offset):
+            page_q = dict(q)
+            page_q['offset'] = offset
+            return self._fetch_page(page_q)[0]
+
+        offsets = range(len(items), total, len(items))
+        for page in util.parallel_map(fetch, offsets, max_workers):
+            items.extend(page)
+        return items
+
+    def iterate(self, page_size=PAGE_SIZE):
+        """ Lazily iterate the results, fetching a page at a time.
+        Only one page of objects is held in memory and pages
+        past the point where iteration stops are never fetched.
+        """
+        for items in self._iter_pages(page_size):
+            for obj in self._wrap_items(items):
+                yield obj
+
+    def aiterate(self, page_size=PAGE_SIZE):
+        """ iterate, but the next page is fetched (and dereferenced)
+        on a worker thread of the db while the current one is consumed.
+        """
+        pages = self._iter_pages(page_size)
+        def next_page():
+            items = next(pages, None)
+            if items is None:
+                return None
+            return self._wrap_items(items)
+
+        submit = self.cls.db.submit
+        pending = submit(next_page)
+        try:
+            while True:
+                objs = pending.get()
+                if objs is None:
+                    return
+                pending = submit(next_page)
+                for obj in objs:
+                    yield obj
+        finally:
+            # when the consumer stops early let the page being
+            # fetched finish and close the pages so nothing is
+            # left suspended on a worker
+            pending.wait()
+            pages.close()
+
+    # non blocking versions of page, all_items and count that run
+    # on the worker threads of the db.  each returns an AsyncResult -
+    # get() waits for the value.  don't change the query until then
+    def apage(self):
+        return self.cls.db.submit(self.page)
+
+    def aall_items(self):
+        return self.cls.db.submit(self.all_items)
+
+    def acount(self):
+        return self.cls.db.submit(self.count)
+
     def __iter__(self):
         return iter(self.all_items())
 
+    # len is the number of items within the offset / limit, count
+    # the number of matches ignoring them
     def __len__(self):
-        return self.count()
+        return self._window_len()
 
+    def _clone(self):
+        q = copy.copy(self)
+        if self.query_obj:
+            q.query_obj = dict(self.query_obj)
+        if self.sort_list:
+            q.sort_list = list(self.sort_list)
+        q._clear_cached_result()
+        return q
+
+    def _is_windowed(self):
+        return bool(self._offset) or self._limit is not None
+
+    # number of items within the offset / limit of the query
+    def _window_len(self):
+        offset = 0 if self._offset is None else self._offset
+        length = max(0, self.count() - offset)
+        if self._limit is not None:
+            length = min(length, self._limit)
+        return length
+
+    # indexes are relative to the offset / limit of the query.
+    # an index fetches just that item and a slice returns a new
+    # query over the sliced range
     def __getitem__(self, x):
-        if self.__len__() < x:
+        if isinstance(x, slice):
+            return self._slice(x)
+
+        if x < 0:
+            x += self._window_len()
+        if x < 0 or (self._limit is not None and x >= self._limit):
             raise IndexError("Index out of range")
-        return self.all_items()[x]
 
+        offset = 0 if self._offset is None else self._offset
+        if self._result and self._is_all:
+            # all_items holds just the window
+            if x >= len(self._result):
+                raise IndexError("Index out of range")
+            return self._result[x]
+
+        q = self._base_query()
+        q['offset'] = offset + x
+        q['limit'] = 1
+        items, self._count = self._fetch_page(q)
+        if len(items) == 0:
+            raise IndexError("Index out of range")
+        return self._wrap_items(items)[0]
+
+    def _slice(self, x):
+        if x.step not in (None, 1):
+            raise SisQueryError("Slice steps are not supported")
+
+        start = 0 if x.start is None else x.start
+        stop = x.stop
+        if start < 0 or (stop is not None and stop < 0):
+            length = self._window_len()
+            if start < 0:
+                start = max(0, start + length)
+            if stop is not None and stop < 0:
+                stop = max(0, stop + length)
+
+        limit = self._limit
+        if limit is not None:
+            limit = max(0, limit - start)
+        if stop is not None:
+            stop_limit = max(0, stop - start)
+            limit = stop_limit if limit is None else min(limit, stop_limit)
+
+        offset = 0 if self._offset is None else self._offset
+        return self._clone().offset(offset + start).limit(limit)
+
+    # number of matches ignoring the offset / limit
     def count(self):
         if self._count != -1:
             return self._count
@@ -101,33 +670,32 @@ class Query(object):
         if self.query_obj:
             q['q'] = self.query_obj
         q['limit'] = 1
-        page = self.endpoint.fetch_page(q)
-        self._count = page._meta.total_count
+        self._count = self._fetch_page(q)[1]
         return self._count
 
     def all_items(self):
         if self._result and self._is_all:
             return self._result
 
-        q = { }
-        if self.query_obj:
-            q['q'] = self.query_obj
-
-        if self.sort_list:
-            q['sort'] = ','.join(self.sort_list)
-
-        if not self._populate:
-            q['populate'] = False
-
-
-        items = self.endpoint.fetch_all(q)
+        if self._keyset or self._is_windowed():
+            # only fetch the items within the offset / limit
+            items = []
+            for page in self._iter_pages(self._page_size):
+                items.extend(page)
+        else:
+            items = self._fetch_all(self._base_query())
+            self._count = len(items)
         self._is_all = True
-        self._count = len(items)
-        self._result = map(lambda o : self.cls(data=o, from_server=True), items)
+        self._result = self._wrap_items(items)
         return self._result
 
     def bulk_delete(self, query):
         res = self.endpoint.delete_bulk(query)
+        identity_map = self.cls._identity_map()
+        if identity_map is not None:
+            for deleted in res['success']:
+                identity_map.remove(self.cls.descriptor['name'], deleted['_id'])
+        self.cls._invalidate_query_cache()
         self._clear_cached_result()
         return res
 
@@ -141,7 +709,7 @@ class Query(object):
 
         q['limit'] = 1
 
-        data = self.endpoint.fetch_page(q)
+        data = self._fetch_page(q)[0]
         count = len(data)
         if count > 1:
             raise SisQueryError("find_one has {count} results".format(count=count))
@@ -150,32 +718,24 @@ class Query(object):
         else:
             item = data[0]
 
-        return self.cls(data=item, from_server=True)
+        return self.cls.from_server(item)
 
     def page(self):
         if self._result:
             if self._is_all:
-                # slice
+                # all_items holds just the window
                 limit = 200 if self._limit is None else self._limit
-                offset = 0 if self._offset is None else self._offset
-                return self._result[offset:limit + offset]
+                return self._result[:limit]
             else:
                 return self._result
 
-        q = { }
-        if self.query_obj:
-            q['q'] = self.query_obj
-        if self.sort_list:
-            q['sort'] = ','.join(self.sort_list)
+        q = self._base_query()
         if self._limit:
             q['limit'] = self._limit
         if self._offset:
             q['offset'] = self._offset
-        if not self._populate:
-            q['populate'] = False
 
-        resp = self.endpoint.fetch_page(q)
-        self._count = resp._meta.total_count
+        items, self._count = self._fetch_page(q)
         # convert to data
-        self._result = map(lambda o : self.cls(data=o, from_server=True), resp)
+        self._result = self._wrap_items(items)
         return self._result
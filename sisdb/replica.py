@@ -0,0 +1,263 @@
+import evaluator
+import copy
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+LOG.addHandler(logging.NullHandler())
+
+# page size of the requests made while syncing
+SYNC_PAGE_SIZE = 500
+
+# seconds between checks for deleted entities
+RECONCILE_INTERVAL = 3600
+
+# path of the modification time of an entity
+UPDATED_AT = '_sis._updated_at'
+
+class SisReplicaError(Exception):
+    def __init__(self, value, *args, **kwargs):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+class Replica(object):
+    """Mirrors the entities of some schemas into a local sqlite
+    database so queries can be answered without SIS.
+
+    The first sync pulls every entity.  Later ones only pull the
+    entities whose _sis._updated_at is at or after the newest one on
+    the server when the previous sync started, and every
+    reconcile_interval seconds the ids are compared with the server's
+    to remove deleted entities (nothing is removed if fewer ids than
+    the server counted were read).
+
+    Entities are replicated without populating their references, so
+    the objects of local queries hold the ids of referenced objects
+    (loaded from the server when read) where server queries hold
+    the objects.  The decoded entities are kept in memory once a
+    schema is read so local queries don't touch sqlite.
+
+    replica = db.replicate(['host', 'service'], path='/tmp/cmdb.db')
+    replica.start(60)
+    hosts = db.host.objects().filter({'status' : 'live'}).local().all_items()
+    """
+
+    def __init__(self, db, schema_names, path=':memory:',
+                 reconcile_interval=RECONCILE_INTERVAL,
+                 page_size=SYNC_PAGE_SIZE):
+        self.db = db
+        self.schema_names = list(schema_names)
+        self.reconcile_interval = reconcile_interval
+        self.page_size = page_size
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._thread = None
+        self._stop = threading.Event()
+        # schema name -> { _id : item } of the schemas read so far
+        self._items = { }
+        # time of the last successful sync and the last exception
+        # of the background thread
+        self.last_sync = None
+        self.last_error = None
+        with self._lock:
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS entities (
+                    schema_name TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    updated_at NUMERIC,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (schema_name, id)
+                );
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    schema_name TEXT PRIMARY KEY,
+                    updated_at NUMERIC,
+                    reconciled_at NUMERIC
+                );
+            ''')
+            self._conn.commit()
+
+    def __contains__(self, schema_name):
+        return schema_name in self.schema_names
+
+    def _state(self, name):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT updated_at, reconciled_at FROM sync_state WHERE schema_name = ?',
+                (name,)).fetchone()
+        if row is None:
+            return (None, None)
+        return row
+
+    def _set_state(self, name, updated_at, reconciled_at):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)',
+                (name, updated_at, reconciled_at))
+            self._conn.commit()
+
+    def _store(self, name, items):
+        rows = []
+        for item in items:
+            updated_at = evaluator.get_path(item, UPDATED_AT)
+            if updated_at is evaluator._MISSING:
+                updated_at = None
+            rows.append((name, item['_id'], updated_at, json.dumps(item)))
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO entities VALUES (?, ?, ?, ?)', rows)
+            self._conn.commit()
+            loaded = self._items.get(name, None)
+            if loaded is not None:
+                for item in items:
+                    loaded[item['_id']] = item
+
+    def _server_query(self, name):
+        # raw items with references left as ids
+        return getattr(self.db, name).objects().populate(False).keyset(self.page_size)
+
+    # the newest _sis._updated_at on the server or None
+    def _server_updated_at(self, name):
+        newest = getattr(self.db, name).objects().populate(False).sort('-' + UPDATED_AT)
+        newest = newest.values_list(UPDATED_AT, flat=True).limit(1).page()
+        if len(newest) == 0:
+            return None
+        return newest[0]
+
+    def sync(self, schema_name=None):
+        """ Pull the changes of one or all of the replicated schemas """
+        names = self.schema_names if schema_name is None else [schema_name]
+        for name in names:
+            if name not in self.schema_names:
+                raise SisReplicaError("%s is not replicated" % name)
+            self._sync_schema(name)
+
+    def _sync_schema(self, name):
+        updated_at, reconciled_at = self._state(name)
+        # taken before the scan so entities saved while it runs are
+        # pulled again by the next sync even if the scan missed them
+        newest = self._server_updated_at(name)
+        if newest is None:
+            newest = updated_at
+        query = self._server_query(name).values()
+        if updated_at is not None:
+            # >= so entities saved in the same ms aren't missed
+            query.filter({ UPDATED_AT : { '$gte' : updated_at } })
+        for items in query._iter_pages(self.page_size):
+            self._store(name, items)
+
+        if reconciled_at is None:
+            # the first sync pulled everything
+            reconciled_at = time.time()
+        elif time.time() - reconciled_at >= self.reconcile_interval:
+            if self._reconcile(name) is not None:
+                reconciled_at = time.time()
+        self._set_state(name, newest, reconciled_at)
+
+    def reconcile(self, schema_name=None):
+        """ Remove the local copies of entities deleted on the server """
+        names = self.schema_names if schema_name is None else [schema_name]
+        for name in names:
+            if self._reconcile(name) is not None:
+                updated_at = self._state(name)[0]
+                self._set_state(name, updated_at, time.time())
+
+    # (ids on the server, whether the scan saw as many as it counted)
+    def _server_ids(self, name):
+        query = self._server_query(name).values_list('_id', flat=True)
+        ids = set(query.iterate(self.page_size))
+        return (ids, query._count is not None and len(ids) >= query._count)
+
+    # the ids of the deleted entities removed, or None when the
+    # server's ids couldn't all be read and nothing was removed
+    def _reconcile(self, name):
+        ids, complete = self._server_ids(name)
+        if not complete:
+            LOG.warning('reconcile of %s skipped, only read %d ids', name, len(ids))
+            return None
+        with self._lock:
+            local_ids = map(lambda r : r[0], self._conn.execute(
+                'SELECT id FROM entities WHERE schema_name = ?', (name,)))
+            deleted = filter(lambda i : i not in ids, local_ids)
+            self._conn.executemany(
+                'DELETE FROM entities WHERE schema_name = ? AND id = ?',
+                map(lambda i : (name, i), deleted))
+            self._conn.commit()
+            loaded = self._items.get(name, None)
+            if loaded is not None:
+                for i in deleted:
+                    loaded.pop(i, None)
+        return deleted
+
+    # the decoded items of a schema by _id, read from sqlite once.
+    # replaced items are swapped rather than changed in place
+    def _loaded(self, schema_name):
+        if schema_name not in self.schema_names:
+            raise SisReplicaError("%s is not replicated" % schema_name)
+        with self._lock:
+            loaded = self._items.get(schema_name, None)
+            if loaded is None:
+                rows = self._conn.execute(
+                    'SELECT data FROM entities WHERE schema_name = ?', (schema_name,))
+                loaded = dict(map(lambda r : (r['_id'], r),
+                                  map(lambda r : json.loads(r[0]), rows)))
+                self._items[schema_name] = loaded
+            return loaded
+
+    # the items q could match without copying them
+    def _candidates(self, schema_name, q):
+        loaded = self._loaded(schema_name)
+        with self._lock:
+            if q and q.keys() == ['_id'] and isinstance(q['_id'], basestring):
+                item = loaded.get(q['_id'], None)
+                return [item] if item is not None else []
+            return loaded.values()
+
+    def items(self, schema_name, q=None):
+        """ Copies of the raw items of a schema, only the one with
+        the _id when q is a plain { '_id' : id } lookup
+        """
+        return copy.deepcopy(self._candidates(schema_name, q))
+
+    def fetch_page(self, schema_name, q):
+        """ (items, total_count) of a fetch_page request answered locally """
+        items, total = evaluator.fetch_page(self._candidates(schema_name, q.get('q', None)), q)
+        # only the page is copied
+        return (copy.deepcopy(items), total)
+
+    def start(self, interval):
+        """ Sync every interval seconds on a background thread """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.sync()
+                    self.last_sync = time.time()
+                    self.last_error = None
+                except Exception as e:
+                    # try again next time
+                    LOG.exception('replica sync failed')
+                    self.last_error = e
+
+        self._thread = threading.Thread(target=run, name='sisdb-replica')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def close(self):
+        self.stop()
+        with self._lock:
+            self._conn.close()
@@ -1,5 +1,7 @@
 import field
+import datastructures
 import query
+import util
 import weakref
 import datetime
 import copy
@@ -21,17 +23,77 @@ SIS_INTERNAL_FIELDS = {
 
 SIS_INTERNAL_FIELD_NAMES = set(SIS_INTERNAL_FIELDS.keys())
 
+# max number of ids sent in a single $in query
+ID_CHUNK_SIZE = 50
+
+# default number of concurrent requests for bulk operations
+BULK_WORKERS = 4
+
+# default number of items sent per bulk create request
+CREATE_CHUNK_SIZE = 100
+
+# from http://stackoverflow.com/questions/312443/how-do-you-split-a-list-into-evenly-sized-chunks-in-python
+def _chunks(l, n):
+    """ Yield successive n-sized chunks from l.
+    """
+    for i in xrange(0, len(l), n):
+        yield l[i:i+n]
+
+# plain copy of a value as it would be sent to SIS
+def _snapshot(val):
+    if isinstance(val, EmbeddedSchema):
+        return _snapshot(val._data)
+    elif isinstance(val, BaseSchema):
+        return val._data.get('_id', None)
+    elif isinstance(val, dict):
+        return dict((k, _snapshot(v)) for k, v in val.iteritems())
+    elif isinstance(val, list):
+        return map(_snapshot, datastructures.raw_items(val))
+    elif (isinstance(val, datetime.datetime) or
+          isinstance(val, datetime.date)):
+        return val.isoformat()
+    return val
+
+# the keys of cur that differ from orig, with None for removed keys
+def _dict_diff(orig, cur):
+    result = {}
+    for k, v in cur.iteritems():
+        if k not in orig:
+            result[k] = v
+        elif orig[k] != v:
+            if isinstance(v, dict) and isinstance(orig[k], dict):
+                result[k] = _dict_diff(orig[k], v)
+            else:
+                result[k] = v
+    for k in orig:
+        if k not in cur:
+            result[k] = None
+    return result
+
 class BaseSchema(object):
+    # generated schema classes add an empty __slots__ as well.
+    # __dict__ is only allocated when an attribute outside the
+    # slots is set on an instance
+    __slots__ = ('_data', '_changed', '_originals', '_clean',
+                 '_initialized', '__weakref__', '__dict__')
+
     def __init__(self, *args, **kwargs):
         self._data = { }
+        # dotted paths of the changed values and a snapshot of
+        # each changed top level field from before it first changed
         self._changed = set()
+        self._originals = { }
+        # names of the fields whose values have been converted
+        self._clean = set()
         self._initialized = False
         if 'data' in kwargs:
             data = kwargs['data']
-            self.set_data(data)
-
-        if kwargs.get('from_server', False):
-            self._changed.clear()
+            if kwargs.get('from_server', False):
+                # keep the server data as is - fields are
+                # converted as they are read
+                self._reset_data(data)
+            else:
+                self.set_data(data)
 
         self._initialized = True
 
@@ -49,14 +111,14 @@ class BaseSchema(object):
         return not self.__eq__(other)
 
     def set_data(self, data):
-        # get the definition keys
-        # make defn_keys the union of the definition and the internal fields
-        defn_keys = set(self.__class__.defn.keys()) | SIS_INTERNAL_FIELD_NAMES
+        # the union of the definition and the internal fields
+        defn_keys = self.__class__._field_names
         data_keys = set([x for x in data])
 
         # clear it
         curr_id = self._data.get('_id', None)
         self._data.clear()
+        self._clean.clear()
         for k in data_keys.intersection(defn_keys):
             setattr(self, k, data[k])
 
@@ -81,18 +143,56 @@ class BaseSchema(object):
         if isinstance(val, BaseSchema):
             val = val.to_saved_dict(False)
         elif isinstance(val, list):
-            val = map(lambda v: self._convert_value(v), val)
+            val = map(lambda v: self._convert_value(v), datastructures.raw_items(val))
         elif (isinstance(val, datetime.datetime) or
               isinstance(val, datetime.date)):
             val = val.isoformat()
         return val
 
+    def _changed_fields(self):
+        changed = set()
+        for path in self._changed:
+            name = path.split('.')[0]
+            if name not in self._data and len(name.split('__')) > 1:
+                # could be an embedded obj
+                name = name.split('__')[1]
+            changed.add(name)
+        return changed
+
+    def _update_dict(self):
+        # only send what differs from the snapshots.  SIS merges
+        # objects on update so a partial object only touches the
+        # keys it contains and None removes a key.
+        result = {}
+        for k in self._changed_fields():
+            if k not in self._data:
+                continue
+            val = self._data[k]
+            original = self._originals.get(k, None)
+            if original is None:
+                result[k] = self._convert_value(val)
+                continue
+
+            curr_val = _snapshot(val)
+            if curr_val == original:
+                # same as what the server has
+                continue
+            if isinstance(curr_val, dict) and isinstance(original, dict):
+                result[k] = _dict_diff(original, curr_val)
+            else:
+                result[k] = self._convert_value(val)
+        return result
+
     def to_saved_dict(self, as_root):
         if not as_root:
             return self._data.get('_id', None)
 
+        if '_id' in self._data:
+            return self._update_dict()
+
+        # new objects send the whole value of each changed field
         result = {}
-        for k in self._changed:
+        for k in self._changed_fields():
             if k in self._data:
                 val = self._data[k]
                 val = self._convert_value(val)
@@ -120,39 +220,98 @@ class BaseSchema(object):
         return defn_keys
 
     def _mark_as_changed(self, name):
+        field_name = name.split('.')[0]
+        if (self._initialized and field_name not in self._originals
+            and field_name in self._data):
+            self._originals[field_name] = _snapshot(self._data[field_name])
         self._changed.add(name)
 
+    def _clear_changes(self):
+        self._changed.clear()
+        self._originals.clear()
+
+    def _reset_data(self, data):
+        if not isinstance(data, dict):
+            # a sispy Response
+            data = dict((k, data[k]) for k in data)
+        # keys the schema doesn't define are dropped like set_data does
+        field_names = self.__class__._field_names
+        if not all(map(lambda k: k in field_names, data)):
+            data = dict((k, v) for k, v in data.iteritems() if k in field_names)
+        self._data = data
+        self._clean.clear()
+
 class SisSchema(BaseSchema):
+    __slots__ = ()
 
     def __init__(self, *args, **kwargs):
         super(SisSchema, self).__init__(*args, **kwargs)
-        self.root_instance = self
-        self.endpoint = self.__class__.db.client.entities(self.__class__.descriptor['name'])
+
+    @property
+    def root_instance(self):
+        return self
+
+    # shared by all instances of the class
+    @property
+    def endpoint(self):
+        return self.__class__._get_endpoint()
+
+    # one endpoint per schema class.  update_schema clears it
+    # when the descriptor changes
+    @classmethod
+    def _get_endpoint(cls):
+        endpoint = cls.__dict__.get('_endpoint', None)
+        if endpoint is None:
+            endpoint = cls.db.client.entities(cls.descriptor['name'])
+            cls._endpoint = endpoint
+        return endpoint
 
     def save(self):
+        session = self.__class__._session()
+        if session is not None:
+            session.add(self)
+            return self
+
         if len(self._changed) > 0:
             client = self.__class__.db.client
             if not client:
-                self._changed.clear()
+                self._clear_changes()
                 return
 
             save_data = self.to_saved_dict(True)
 
             if '_id' in self._data:
                 # update
-                self._data = self.endpoint.update(self._data['_id'], save_data)._result
+                if len(save_data) == 0:
+                    # nothing really changed
+                    self._clear_changes()
+                    return self
+                self._reset_data(self.endpoint.update(self._data['_id'], save_data)._result)
             else:
-                self._data = self.endpoint.create(save_data)._result
+                self._reset_data(self.endpoint.create(save_data)._result)
+                identity_map = self.__class__._identity_map()
+                if identity_map is not None:
+                    identity_map.add(self.descriptor['name'], self._data['_id'], self)
 
-            self._changed.clear()
+            self.__class__._invalidate_query_cache()
+            self._clear_changes()
         return self
 
     def delete(self):
+        session = self.__class__._session()
+        if session is not None:
+            session.delete(self)
+            return
+
         if '_id' in self._data:
             self.endpoint.delete(self._data['_id'])
+            identity_map = self.__class__._identity_map()
+            if identity_map is not None:
+                identity_map.remove(self.descriptor['name'], self._data['_id'])
+            self.__class__._invalidate_query_cache()
 
-        self._data = { }
-        self._changed.clear()
+        self._reset_data({ })
+        self._clear_changes()
 
     @classmethod
     def get(cls, q_obj=None, **kwargs):
@@ -165,60 +324,192 @@ class SisSchema(BaseSchema):
         #print query_obj
         if len(query_obj) == 0:
             return None
+        # page fills in the count so this is a single request
         query.filter(query_obj).limit(1)
-        result = query.all_items()
+        result = query.page()
         if query.count() != 1:
             return None
         return result[0]
 
+    def _mark_as_changed(self, name):
+        super(SisSchema, self)._mark_as_changed(name)
+        # objects on the server are flushed by an active session
+        # without needing to be saved
+        if self._initialized and '_id' in self._data:
+            session = self.__class__._session()
+            if session is not None:
+                session.add(self)
+
+    @classmethod
+    def _session(cls):
+        current_session = getattr(cls.db, 'current_session', None)
+        if current_session is None:
+            return None
+        return current_session()
+
+    @classmethod
+    def _identity_map(cls):
+        return getattr(cls.db, 'identity_map', None)
+
+    @classmethod
+    def _invalidate_query_cache(cls):
+        query_cache = getattr(cls.db, 'query_cache', None)
+        if query_cache is not None:
+            query_cache.invalidate(cls.descriptor['name'])
+
+    @classmethod
+    def from_server(cls, data):
+        """ Wrap an item returned by SIS.  When the db has an identity
+        map the object already loaded for the _id is reused (and
+        refreshed if it has no pending changes).
+        """
+        identity_map = cls._identity_map()
+        if identity_map is None or '_id' not in data:
+            return cls(data=data, from_server=True)
+
+        name = cls.descriptor['name']
+        obj = identity_map.get(name, data['_id'])
+        if obj is None:
+            obj = cls(data=data, from_server=True)
+            identity_map.add(name, data['_id'], obj)
+        elif len(obj._changed) == 0:
+            obj._reset_data(data)
+        return obj
+
+    # non blocking versions of save, delete, load and get that run on
+    # the worker threads of the db.  they return an AsyncResult and
+    # are sent straight away, even inside a session
+    def asave(self):
+        return self.__class__.db.submit(self.save)
+
+    def adelete(self):
+        return self.__class__.db.submit(self.delete)
+
+    @classmethod
+    def aload(cls, elem_id):
+        return cls.db.submit(cls.load, elem_id)
+
+    @classmethod
+    def aget(cls, q_obj=None, **kwargs):
+        return cls.db.submit(cls.get, q_obj, **kwargs)
+
+    # concurrent identical requests share a single fetch when the
+    # db coalesces them, except inside a session where the caller
+    # has writes pending
+    @classmethod
+    def _coalesce(cls, key, fetch):
+        single_flight = getattr(cls.db, 'single_flight', None)
+        if single_flight is None or cls._session() is not None:
+            return fetch()
+        return single_flight.do((cls.descriptor['name'],) + key, fetch)
+
     @classmethod
     def load(cls, elem_id):
-        return cls(data=cls.db.client.entities(cls.descriptor['name']).get(elem_id), from_server=True)
+        identity_map = cls._identity_map()
+        if identity_map is not None:
+            obj = identity_map.get(cls.descriptor['name'], elem_id)
+            if obj is not None:
+                return obj
+        endpoint = cls._get_endpoint()
+        data = cls._coalesce(('get', elem_id), lambda: endpoint.get(elem_id))
+        return cls.from_server(data)
+
+    @classmethod
+    def load_many(cls, elem_ids, chunk_size=ID_CHUNK_SIZE):
+        """ Load several objects with one $in query per chunk of ids.
+        Returns a dict of _id -> object.  Missing ids are left out.
+        """
+        ids = sorted(set(elem_ids))
+        result = { }
+        identity_map = cls._identity_map()
+        if identity_map is not None:
+            name = cls.descriptor['name']
+            for elem_id in ids:
+                obj = identity_map.get(name, elem_id)
+                if obj is not None:
+                    result[elem_id] = obj
+            ids = filter(lambda i: i not in result, ids)
+
+        if len(ids) == 0:
+            return result
+
+        endpoint = cls._get_endpoint()
+        for p in _chunks(ids, chunk_size):
+            fetch = lambda: list(endpoint.fetch_all({ 'q' : { '_id' : { '$in' : p }}}))
+            items = cls._coalesce(('in', tuple(p)), fetch)
+            for item in items:
+                obj = cls.from_server(item)
+                result[obj._id] = obj
+        return result
 
     @classmethod
     def objects(cls):
-        return query.Query(cls.db.client.entities(cls.descriptor['name']), cls)
+        return query.Query(cls._get_endpoint(), cls)
 
     @classmethod
     def find_one(cls, q):
-        return query.Query(cls.db.client.entities(cls.descriptor['name']), cls).find_one(q)
+        return query.Query(cls._get_endpoint(), cls).find_one(q)
 
     @classmethod
-    def bulk_delete(cls, items):
-        # from http://stackoverflow.com/questions/312443/how-do-you-split-a-list-into-evenly-sized-chunks-in-python
-        def chunks(l, n):
-            """ Yield successive n-sized chunks from l.
-            """
-            for i in xrange(0, len(l), n):
-                yield l[i:i+n]
-        #end chunks
-
+    def bulk_delete(cls, items, chunk_size=ID_CHUNK_SIZE, max_workers=BULK_WORKERS):
+        """ Delete items with $in queries of chunk_size ids, sending
+        up to max_workers chunks at the same time.
+        Returns (num_deleted, errors)
+        """
         # build the $in query
         ids = map(lambda i: i._id, items)
         if len(ids) == 0:
             return (0, [])
 
+        endpoint = cls._get_endpoint()
+        def delete_chunk(p):
+            return endpoint.delete_bulk({ 'q' : { '_id' : { '$in' : p }}})
+
         errors = []
         num_deleted = 0
-
-        # delete 50 at a time - TODO make this not be awful
-        parts = chunks(ids, 50)
-        for p in parts:
-            endpoint = cls.db.client.entities(cls.descriptor['name'])
-            res = endpoint.delete_bulk({ 'q' : { '_id' : { '$in' : p }}})
+        identity_map = cls._identity_map()
+        results = util.parallel_map(delete_chunk, _chunks(ids, chunk_size), max_workers)
+        for res in results:
             num_deleted += len(res['success'])
             errors += res['errors']
+            if identity_map is not None:
+                for deleted in res['success']:
+                    identity_map.remove(cls.descriptor['name'], deleted['_id'])
 
+        cls._invalidate_query_cache()
         return (num_deleted, errors)
 
     @classmethod
-    def bulk_create(cls, items):
-        if not isinstance(items, list):
+    def bulk_create_iter(cls, items, chunk_size=CREATE_CHUNK_SIZE, max_workers=BULK_WORKERS):
+        """ Create items (objects or dicts) from any iterable, or a single
+        object or dict, posting chunk_size items per request with at most
+        max_workers requests in flight.  The iterable is consumed as chunks
+        are sent, so it can be a generator of any length.
+        Yields (created, errors) for each chunk in order.
+        """
+        if isinstance(items, (BaseSchema, dict)):
+            # a single item, not an iterable of them
             items = [items]
-        items = map(lambda i: i.to_saved_dict(True), items)
-        endpoint = cls.db.client.entities(cls.descriptor['name'])
-        res = endpoint.create(items)
-        created = map(lambda x: cls(data=x, from_server=True), res['success'])
+
+        def to_item(i):
+            if isinstance(i, BaseSchema):
+                return i.to_saved_dict(True)
+            return i
+
+        endpoint = cls._get_endpoint()
+        def create_chunk(chunk):
+            return endpoint.create(map(to_item, chunk))
+
+        for res in util.bounded_imap(create_chunk, util.ichunks(items, chunk_size), max_workers):
+            cls._invalidate_query_cache()
+            created = map(cls.from_server, res['success'])
+            yield (created, res['errors'])
+
+    @classmethod
+    def bulk_create(cls, items, chunk_size=CREATE_CHUNK_SIZE, max_workers=BULK_WORKERS):
+        created = []
+        for chunk_created, errors in cls.bulk_create_iter(items, chunk_size, max_workers):
+            created += chunk_created
         return created
 
     @classmethod
@@ -243,6 +534,7 @@ class SisSchema(BaseSchema):
                 setattr(cls, k, field.create_field(new_defn[k], k, sisdb, name))
 
         setattr(cls, 'defn', new_defn)
+        setattr(cls, '_field_names', _field_names(new_defn))
 
 
     @classmethod
@@ -250,15 +542,26 @@ class SisSchema(BaseSchema):
         if cls.descriptor != desc:
             # make sure the schema gets updated
             if cls.db.client:
-                desc = cls.db.client.schemas.update(desc['name'], desc)
+                desc = cls.db.client.schemas.update(desc['name'], desc)._result
+            cls._refresh_schema(desc)
 
-            new_defn = desc['definition']
-            old_defn = cls.descriptor['definition']
-            cls.descriptor = desc
-            if old_defn != new_defn:
-                cls._update_defn(old_defn, new_defn)
+    # apply a descriptor that came from the server.  the class
+    # is updated in place so existing objects stay valid
+    @classmethod
+    def _refresh_schema(cls, desc):
+        if cls.descriptor is desc or cls.descriptor == desc:
+            return
+        new_defn = desc['definition']
+        old_defn = cls.descriptor['definition']
+        cls.descriptor = desc
+        # rebuilt on next use
+        cls._endpoint = None
+        if old_defn != new_defn:
+            cls._update_defn(old_defn, new_defn)
 
 class EmbeddedSchema(BaseSchema):
+    __slots__ = ('root_schema', 'key_name')
+
     def __init__(self, root_schema, key_name, *args, **kwargs):
         super(EmbeddedSchema, self).__init__(args, kwargs)
         if isinstance(root_schema, weakref.ProxyType):
@@ -268,8 +571,9 @@ class EmbeddedSchema(BaseSchema):
         self.key_name = key_name
 
     def _mark_as_changed(self, name):
-        # tell the root schema that we changed
-        self.root_schema._mark_as_changed(self.key_name)
+        # tell the root schema which path changed
+        if self._initialized:
+            self.root_schema._mark_as_changed('.'.join([self.key_name, name]))
 
     def to_saved_dict(self, as_root):
         result = {}
@@ -280,10 +584,15 @@ class EmbeddedSchema(BaseSchema):
         return result
 
 
+def _field_names(defn):
+    return frozenset(defn.keys()) | SIS_INTERNAL_FIELD_NAMES
+
 def create_embedded_schema(sisdb, defn, name):
     attrs = {
+        '__slots__' : (),
         'db' : sisdb,
-        'defn' : defn
+        'defn' : defn,
+        '_field_names' : _field_names(defn) if type(defn) == dict else SIS_INTERNAL_FIELD_NAMES
     }
 
     if type(defn) == dict:
@@ -298,8 +607,10 @@ def create_schema(sisdb, schema):
     defn = schema['definition']
 
     attrs = {
+        '__slots__' : (),
         'db' : sisdb,
         'defn' : defn,
+        '_field_names' : _field_names(defn),
         'descriptor' : schema
     }
 
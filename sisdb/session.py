@@ -0,0 +1,192 @@
+import collections
+import schema
+
+class SisSessionError(Exception):
+    def __init__(self, value, errors=None, *args, **kwargs):
+        self.value = value
+        # list of (object, error) tuples
+        self.errors = errors or []
+
+    def __str__(self):
+        return repr(self.value)
+
+# position in the request of each item of a bulk create that failed.
+# errors give the index of the item; when one doesn't, the item is
+# found by the value the error carries, after the previous failure
+# since errors are reported in request order.  returns
+# ({ position : error }, [errors that match no item])
+def _failed_positions(items, errors):
+    failed = { }
+    unmatched = []
+    start = 0
+    for err in errors:
+        pos = err.get('index', None) if isinstance(err, dict) else None
+        if not isinstance(pos, (int, long)) or not 0 <= pos < len(items) or pos in failed:
+            pos = None
+            value = err.get('value', None) if isinstance(err, dict) else None
+            for i in xrange(start, len(items)):
+                if i not in failed and items[i] == value:
+                    pos = i
+                    break
+        if pos is None:
+            unmatched.append(err)
+        else:
+            failed[pos] = err
+            start = pos + 1
+    return (failed, unmatched)
+
+class Session(object):
+    """Unit of work for a SisDb.  While a session is active on a thread,
+    save() and delete() are recorded instead of sent, as are changes to
+    objects that already exist on the server.  Everything is flushed on
+    exit as chunked bulk creates, bulk updates and $in bulk deletes.
+
+    New objects are only recorded when save() (or add) is called on them.
+    """
+
+    def __init__(self, db, chunk_size=schema.ID_CHUNK_SIZE):
+        self.db = db
+        self.chunk_size = chunk_size
+        self._new = collections.OrderedDict()
+        self._dirty = collections.OrderedDict()
+        self._deleted = collections.OrderedDict()
+        self._prev_session = None
+
+    def __enter__(self):
+        self._prev_session = self.db.current_session()
+        self.db._local.session = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.db._local.session = self._prev_session
+            self._prev_session = None
+        return False
+
+    def add(self, obj):
+        key = id(obj)
+        if key in self._deleted:
+            return
+        if '_id' in obj._data:
+            self._dirty[key] = obj
+        else:
+            self._new[key] = obj
+
+    def delete(self, obj):
+        key = id(obj)
+        self._dirty.pop(key, None)
+        if self._new.pop(key, None) is not None:
+            # never made it to the server
+            obj._reset_data({ })
+            obj._clear_changes()
+        elif '_id' in obj._data:
+            self._deleted[key] = obj
+
+    def _by_class(self, objs):
+        result = collections.OrderedDict()
+        for obj in objs:
+            result.setdefault(obj.__class__, []).append(obj)
+        return result
+
+    def flush(self):
+        """ Send the recorded changes.  Objects are updated with the
+        server results; a SisSessionError listing the objects that
+        failed is raised after everything has been sent.
+        """
+        new = self._new.values()
+        dirty = filter(lambda o: len(o._changed) > 0, self._dirty.values())
+        deleted = self._deleted.values()
+        self._new.clear()
+        self._dirty.clear()
+        self._deleted.clear()
+
+        errors = []
+        for cls, objs in self._by_class(new).iteritems():
+            errors += self._flush_new(cls, objs)
+        for cls, objs in self._by_class(dirty).iteritems():
+            errors += self._flush_dirty(cls, objs)
+        for cls, objs in self._by_class(deleted).iteritems():
+            errors += self._flush_deleted(cls, objs)
+
+        if len(errors) > 0:
+            raise SisSessionError("%d objects failed to flush" % len(errors), errors)
+
+    def _saved(self, obj, data):
+        obj._reset_data(data)
+        obj._clear_changes()
+        identity_map = obj.__class__._identity_map()
+        if identity_map is not None:
+            identity_map.add(obj.descriptor['name'], data['_id'], obj)
+
+    def _flush_new(self, cls, objs):
+        errors = []
+        endpoint = cls._get_endpoint()
+        for part in schema._chunks(objs, self.chunk_size):
+            items = map(lambda o: o.to_saved_dict(True), part)
+            res = endpoint.create(items)
+            # the rest succeeded in order
+            failed, unmatched = _failed_positions(items, res['errors'])
+            errors += map(lambda err: (None, err), unmatched)
+            succeeded = iter(res['success'])
+            for i, obj in enumerate(part):
+                if i in failed:
+                    errors.append((obj, failed[i]))
+                else:
+                    data = next(succeeded, None)
+                    if data is not None:
+                        self._saved(obj, data)
+        cls._invalidate_query_cache()
+        return errors
+
+    def _flush_dirty(self, cls, objs):
+        errors = []
+        endpoint = cls._get_endpoint()
+        for part in schema._chunks(objs, self.chunk_size):
+            by_id = { }
+            items = []
+            for obj in part:
+                item = obj.to_saved_dict(True)
+                if len(item) == 0:
+                    # nothing really changed
+                    obj._clear_changes()
+                    continue
+                item['_id'] = obj._data['_id']
+                by_id[item['_id']] = obj
+                items.append(item)
+            if len(items) == 0:
+                continue
+            res = endpoint.update_bulk(items)
+            for data in res['success']:
+                obj = by_id.pop(data['_id'], None)
+                if obj is not None:
+                    self._saved(obj, data)
+            for err in res['errors']:
+                value = err.get('value', None) if isinstance(err, dict) else None
+                obj_id = value.get('_id', None) if isinstance(value, dict) else None
+                errors.append((by_id.pop(obj_id, None), err))
+        cls._invalidate_query_cache()
+        return errors
+
+    def _flush_deleted(self, cls, objs):
+        errors = []
+        endpoint = cls._get_endpoint()
+        identity_map = cls._identity_map()
+        for part in schema._chunks(objs, self.chunk_size):
+            by_id = dict(map(lambda o: (o._data['_id'], o), part))
+            res = endpoint.delete_bulk({ 'q' : { '_id' : { '$in' : by_id.keys() }}})
+            for data in res['success']:
+                obj = by_id.pop(data['_id'], None)
+                if obj is not None:
+                    if identity_map is not None:
+                        identity_map.remove(cls.descriptor['name'], data['_id'])
+                    obj._reset_data({ })
+                    obj._clear_changes()
+            for err in res['errors']:
+                value = err.get('value', None) if isinstance(err, dict) else None
+                obj_id = value.get('_id', None) if isinstance(value, dict) else None
+                errors.append((by_id.pop(obj_id, None), err))
+        cls._invalidate_query_cache()
+        return errors
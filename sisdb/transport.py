@@ -0,0 +1,77 @@
+import Queue
+import threading
+import sispy
+from sispy import http
+
+# default number of connections kept by a PooledHTTPHandler
+POOL_SIZE = 10
+
+def _default_handler():
+    # requests keeps the connection alive between requests.  the
+    # stdlib handler opens a new one each time
+    if http.HTTP_LIB == 'requests':
+        return http.RequestsHandler(http_keep_alive=True)
+    return http.StdLibHandler()
+
+class PooledHTTPHandler(http.BaseHTTPHandler):
+    """sispy http handler for clients shared between threads.  Each
+    request checks out one of at most max_size keep-alive handlers (one
+    requests.Session each) so no two threads share a connection.  When
+    all of them are busy the request waits for one to be returned.
+
+    db = sisdb.SisDb(client, http_handler=PooledHTTPHandler(max_size=8))
+    """
+
+    def __init__(self, max_size=POOL_SIZE, factory=_default_handler):
+        super(PooledHTTPHandler, self).__init__()
+        self.max_size = max_size
+        self._factory = factory
+        # the most recently used handler has the warmest connection
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _checkout(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        try:
+            return self._factory()
+        except:
+            self._slots.release()
+            raise
+
+    def _checkin(self, handler):
+        if handler is not None:
+            self._idle.put(handler)
+        self._slots.release()
+
+    def request(self, request):
+        handler = self._checkout()
+        reuse = False
+        try:
+            result = handler.request(request)
+            reuse = True
+            return result
+        except sispy.Error:
+            # the server answered so the connection is still good
+            reuse = True
+            raise
+        finally:
+            if not reuse:
+                _close_handler(handler)
+            self._checkin(handler if reuse else None)
+
+    def close(self):
+        """ Close the idle connections """
+        while True:
+            try:
+                _close_handler(self._idle.get_nowait())
+            except Queue.Empty:
+                return
+
+def _close_handler(handler):
+    session = getattr(handler, '_session', None)
+    if session is not None:
+        session.close()
@@ -0,0 +1,106 @@
+from multiprocessing.pool import ThreadPool
+import collections
+import copy
+import itertools
+import sys
+import threading
+
+def parallel_map(func, items, max_workers):
+    """ map func over items using at most max_workers threads.
+    Results are returned in the same order as items.
+    """
+    items = list(items)
+    num_workers = min(max_workers, len(items))
+    if num_workers <= 1:
+        return map(func, items)
+
+    pool = ThreadPool(num_workers)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def bounded_imap(func, items, max_workers):
+    """ Lazy version of parallel_map.  items are only pulled from the
+    iterable while fewer than max_workers calls are in flight, and
+    results are yielded in order as they complete.
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = ThreadPool(max_workers)
+    try:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= max_workers:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+    finally:
+        # let requests already sent finish
+        pool.close()
+        pool.join()
+
+def ichunks(items, n):
+    """ Yield successive n-sized lists from any iterable
+    """
+    it = iter(items)
+    while True:
+        chunk = list(itertools.islice(it, n))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """ Makes one call per key at a time.  Callers asking for a key
+    that is already in flight wait for that call and get a copy of its
+    result (or its exception) instead of making their own.
+    """
+
+    def __init__(self, copy_result=copy.deepcopy):
+        self.copy_result = copy_result
+        self._lock = threading.Lock()
+        self._calls = { }
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key, None)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.waiters += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return self.copy_result(call.result)
+
+        try:
+            result = func()
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                waiters = call.waiters
+            if waiters > 0 and call.error is None:
+                # the caller may modify the result so the waiters
+                # copy from a snapshot taken before it's returned
+                call.result = self.copy_result(result)
+            call.done.set()
+        return result
@@ -0,0 +1,89 @@
+""" Microbenchmark of field reads.  Runs without a SIS server:
+
+python test/bench_fields.py
+"""
+import sys
+import os
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sisdb
+
+NUM_OBJECTS = 1000
+NUM_READS = 20
+
+REF_SCHEMA = {
+    'name' : 'bench_ref',
+    'definition' : { 'name' : 'String' }
+}
+
+SCHEMA = {
+    'name' : 'bench',
+    'definition' : {
+        'str_field' : 'String',
+        'num_field' : 'Number',
+        'bool_field' : 'Boolean',
+        'date_field' : 'Date',
+        'mixed_field' : 'Mixed',
+        'list_field' : ['String'],
+        'ref_field' : { 'type' : 'ObjectId', 'ref' : 'bench_ref' },
+        'ref_list_field' : [{ 'type' : 'ObjectId', 'ref' : 'bench_ref' }],
+        'embedded_field' : { 'inner' : 'String' }
+    }
+}
+
+def _ref(i):
+    return { '_id' : 'ref%d' % i, 'name' : 'ref %d' % i }
+
+def _item(i):
+    return {
+        '_id' : 'obj%d' % i,
+        'str_field' : 'value %d' % i,
+        'num_field' : '%d' % i,
+        'bool_field' : 'true',
+        'date_field' : '2014-01-14T15:24:44.168Z',
+        'mixed_field' : { 'a' : i },
+        'list_field' : ['a', 'b', 'c'],
+        'ref_field' : _ref(i),
+        'ref_list_field' : [_ref(i), _ref(i + 1)],
+        'embedded_field' : { 'inner' : 'inner %d' % i }
+    }
+
+class OfflineClient(object):
+    """ Just enough of a sispy client to build the schema classes """
+    version = 1.1
+
+    def __init__(self):
+        self.schemas = self
+
+    def fetch_all(self, opts=None):
+        return [REF_SCHEMA, SCHEMA]
+
+    def entities(self, name):
+        return None
+
+def bench_field(cls, items, name):
+    objs = map(cls.from_server, items)
+    if name == 'ref_list_field':
+        read = lambda o: o.ref_list_field[1]
+    else:
+        read = lambda o: getattr(o, name)
+
+    def run():
+        for o in objs:
+            for i in xrange(NUM_READS):
+                read(o)
+    return min(timeit.repeat(run, number=1, repeat=3))
+
+def main():
+    db = sisdb.SisDb(OfflineClient())
+    cls = db.bench
+    items = map(_item, xrange(NUM_OBJECTS))
+    print '%d objects, %d reads each' % (NUM_OBJECTS, NUM_READS)
+    for name in sorted(SCHEMA['definition'].keys()):
+        elapsed = bench_field(cls, items, name)
+        per_read = elapsed / (NUM_OBJECTS * NUM_READS) * 1e9
+        print '%-16s %8.1f ms %8.0f ns/read' % (name, elapsed * 1000, per_read)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+""" Memory used per entity, including its containers.  Runs
+without a SIS server:
+
+python test/bench_memory.py
+"""
+import sys
+import os
+import gc
+import types
+import weakref
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sisdb
+import bench_fields
+
+NUM_OBJECTS = 1000
+
+class OfflineEndpoint(object):
+    """ Same attributes as a sispy Endpoint """
+    def __init__(self, endpoint, client):
+        self.endpoint = endpoint
+        self.client = client
+
+class OfflineClient(bench_fields.OfflineClient):
+    def entities(self, name):
+        return OfflineEndpoint('entities/{0}'.format(name), self)
+
+# objects that are shared by every entity
+_SHARED = (type, types.ModuleType, types.FunctionType, weakref.ProxyType,
+           weakref.CallableProxyType, sisdb.SisDb, OfflineClient)
+
+def deep_size(obj, seen):
+    if id(obj) in seen or isinstance(obj, _SHARED):
+        return 0
+    seen.add(id(obj))
+    # the referents are the items of containers and the slots
+    # of objects, and their __dict__ only if it was allocated
+    return sys.getsizeof(obj) + sum(map(lambda v: deep_size(v, seen),
+                                        gc.get_referents(obj)))
+
+def main():
+    db = sisdb.SisDb(OfflineClient())
+    cls = db.bench
+    objs = map(cls.from_server, map(bench_fields._item, xrange(NUM_OBJECTS)))
+    # create all of the containers
+    for o in objs:
+        for name in bench_fields.SCHEMA['definition'].keys():
+            getattr(o, name)
+
+    seen = set()
+    total = sum(map(lambda o: deep_size(o, seen), objs))
+    print '%d entities: %d bytes per entity' % (NUM_OBJECTS, total / NUM_OBJECTS)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+""" An in memory stand in for the sispy client so the behavior of
+sisdb can be tested without a SIS server.  Queries are answered with
+sisdb.evaluator and every request is recorded in client.calls.
+"""
+import sys
+import os
+import copy
+import itertools
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sispy
+from sispy import Response, Meta
+from sispy.endpoint import Endpoint
+from sisdb import evaluator
+
+# the server's default page size
+DEFAULT_LIMIT = 200
+
+class Calls(object):
+    """ The requests made against a MemoryClient """
+
+    def __init__(self):
+        self.log = []
+        self._lock = threading.Lock()
+
+    def add(self, kind, *args):
+        with self._lock:
+            self.log.append((kind,) + args)
+
+    def count(self, kind=None):
+        return len(filter(lambda c : kind is None or c[0] == kind, self.log))
+
+    def reset(self):
+        with self._lock:
+            self.log = []
+
+
+class MemoryEndpoint(Endpoint):
+
+    @property
+    def store(self):
+        return self.client.data.setdefault(self.endpoint, [])
+
+    def _find(self, id):
+        for item in self.store:
+            if item['_id'] == id:
+                return item
+        return None
+
+    def _wait(self):
+        if self.client.delay:
+            with self.client.lock:
+                self.client.in_flight += 1
+                self.client.max_in_flight = max(self.client.max_in_flight,
+                                                self.client.in_flight)
+            time.sleep(self.client.delay)
+            with self.client.lock:
+                self.client.in_flight -= 1
+        if self.client.error is not None:
+            raise self.client.error
+
+    def fetch_page(self, query=None):
+        self.client.calls.add('fetch_page', self.endpoint, copy.deepcopy(query))
+        self._wait()
+        query = dict(query or { })
+        if query.get('limit', None) is None:
+            query['limit'] = DEFAULT_LIMIT
+        if self.client.max_limit is not None:
+            query['limit'] = min(query['limit'], self.client.max_limit)
+        with self.client.lock:
+            items, total = evaluator.fetch_page(copy.deepcopy(self.store), query)
+        return Response(items, Meta({ 'x-total-count' : str(total) }))
+
+    def get(self, id):
+        self.client.calls.add('get', self.endpoint, id)
+        self._wait()
+        with self.client.lock:
+            item = self._find(id)
+        if item is None:
+            raise sispy.Error('%s not found' % id, http_status_code=404)
+        return Response(copy.deepcopy(item), Meta({ }))
+
+    def _create_one(self, content):
+        item = copy.deepcopy(content)
+        item['_id'] = self.client.next_id()
+        item.setdefault('_sis', { })
+        item['_sis']['_updated_at'] = self.client.now()
+        self.store.append(item)
+        return copy.deepcopy(item)
+
+    def create(self, content):
+        self.client.calls.add('create', self.endpoint, copy.deepcopy(content))
+        self._wait()
+        with self.client.lock:
+            if not isinstance(content, list):
+                return Response(self._create_one(content), Meta({ }))
+            result = { 'success' : [], 'errors' : [] }
+            for i, c in enumerate(content):
+                if c.get('name', None) in self.client.reject:
+                    # the value is the item as the server saw it
+                    value = copy.deepcopy(c)
+                    value.setdefault('_sis', { })
+                    result['errors'].append({ 'error' : 'rejected', 'index' : i,
+                                              'value' : value })
+                else:
+                    result['success'].append(self._create_one(c))
+            return Response(result, Meta({ }))
+
+    def _merge(self, item, content):
+        for k, v in content.iteritems():
+            if isinstance(v, dict) and isinstance(item.get(k, None), dict):
+                self._merge(item[k], v)
+            elif v is None:
+                item.pop(k, None)
+            else:
+                item[k] = copy.deepcopy(v)
+
+    def _update_one(self, id, content):
+        item = self._find(id)
+        if item is None:
+            return None
+        self._merge(item, content)
+        item.setdefault('_sis', { })
+        item['_sis']['_updated_at'] = self.client.now()
+        return copy.deepcopy(item)
+
+    def update(self, id, content, query=None):
+        self.client.calls.add('update', self.endpoint, id, copy.deepcopy(content))
+        self._wait()
+        with self.client.lock:
+            item = self._update_one(id, content)
+        if item is None:
+            raise sispy.Error('%s not found' % id, http_status_code=404)
+        return Response(item, Meta({ }))
+
+    def update_bulk(self, content, query=None):
+        self.client.calls.add('update_bulk', self.endpoint, copy.deepcopy(content))
+        self._wait()
+        result = { 'success' : [], 'errors' : [] }
+        with self.client.lock:
+            for c in content:
+                item = self._update_one(c['_id'], c)
+                if item is None:
+                    result['errors'].append({ 'error' : 'not found', 'value' : c })
+                else:
+                    result['success'].append(item)
+        return Response(result, Meta({ }))
+
+    def delete(self, id):
+        self.client.calls.add('delete', self.endpoint, id)
+        self._wait()
+        with self.client.lock:
+            self.client.data[self.endpoint] = filter(lambda i : i['_id'] != id, self.store)
+        return Response(True, Meta({ }))
+
+    def delete_bulk(self, query):
+        self.client.calls.add('delete_bulk', self.endpoint, copy.deepcopy(query))
+        self._wait()
+        q = query.get('q', None)
+        with self.client.lock:
+            deleted = filter(lambda i : evaluator.matches(i, q), self.store)
+            self.client.data[self.endpoint] = filter(
+                lambda i : not evaluator.matches(i, q), self.store)
+        return Response({ 'success' : deleted, 'errors' : [] }, Meta({ }))
+
+
+class MemorySchemas(MemoryEndpoint):
+
+    def __init__(self, client):
+        super(MemorySchemas, self).__init__('schemas', client)
+
+    def _find(self, name):
+        for s in self.store:
+            if s['name'] == name:
+                return s
+        return None
+
+    def get(self, name):
+        self.client.calls.add('schema_get', name)
+        s = self._find(name)
+        if s is None:
+            raise sispy.Error('%s not found' % name, http_status_code=404)
+        return Response(copy.deepcopy(s), Meta({ }))
+
+    def create(self, content):
+        self.client.calls.add('schema_create', content['name'])
+        s = copy.deepcopy(content)
+        s['_id'] = self.client.next_id()
+        s['_updated_at'] = self.client.now()
+        with self.client.lock:
+            self.store.append(s)
+        return Response(copy.deepcopy(s), Meta({ }))
+
+    def update(self, name, content, query=None):
+        self.client.calls.add('schema_update', name)
+        s = self._find(name)
+        if s is None:
+            raise sispy.Error('%s not found' % name, http_status_code=404)
+        with self.client.lock:
+            s.clear()
+            s.update(copy.deepcopy(content))
+            s['_updated_at'] = self.client.now()
+        return Response(copy.deepcopy(s), Meta({ }))
+
+    def delete(self, name):
+        self.client.calls.add('schema_delete', name)
+        with self.client.lock:
+            self.client.data[self.endpoint] = filter(lambda s : s['name'] != name, self.store)
+            self.client.data.pop(name, None)
+        return Response(True, Meta({ }))
+
+
+class MemoryClient(object):
+    """ A sispy.Client over dicts.  delay slows every request down
+    (max_in_flight is the most that were concurrent), error, when
+    set, is raised by every request and max_limit caps the page size
+    """
+    version = 1.1
+
+    def __init__(self):
+        self.data = { }
+        self.calls = Calls()
+        self.lock = threading.RLock()
+        self.delay = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.error = None
+        self.max_limit = None
+        # names of the entities bulk creates fail for
+        self.reject = set()
+        self.num_endpoints = 0
+        self._ids = itertools.count(1)
+        self._clock = itertools.count(1)
+        self.schemas = MemorySchemas(self)
+
+    def next_id(self):
+        return u'%024x' % next(self._ids)
+
+    # strictly increasing modification times
+    def now(self):
+        return next(self._clock)
+
+    def entities(self, name):
+        self.num_endpoints += 1
+        return MemoryEndpoint(name, self)
+
+    def add(self, name, *items):
+        """ Store items directly, without recording a request """
+        with self.lock:
+            return map(lambda i : MemoryEndpoint(name, self)._create_one(i), items)
+
+
+REF_SCHEMA = {
+    'name' : 'test_sisdb_ref',
+    'owner' : ['sisdb'],
+    'definition' : {
+        'ref_name' : 'String',
+        'type' : 'Number'
+    }
+}
+
+SCHEMA = {
+    'name' : 'test_sisdb',
+    'owner' : ['sisdb'],
+    'definition' : {
+        'name' : 'String',
+        'living' : 'Boolean',
+        'age' : 'Number',
+        'created' : 'Date',
+        'mixed' : 'Mixed',
+        'tags' : ['String'],
+        'nested' : {
+            'stuff' : 'String',
+            'deep' : { 'x' : 'Number' }
+        },
+        'reference' : { 'type' : 'ObjectId', 'ref' : 'test_sisdb_ref' },
+        'refs' : [{ 'type' : 'ObjectId', 'ref' : 'test_sisdb_ref' }]
+    }
+}
+
+def client(num_refs=3, num_items=5):
+    """ A MemoryClient with the test schemas and some entities """
+    c = MemoryClient()
+    c.schemas.create(REF_SCHEMA)
+    c.schemas.create(SCHEMA)
+    refs = c.add('test_sisdb_ref', *map(lambda i : { 'ref_name' : 'ref%d' % i, 'type' : i },
+                                        range(num_refs)))
+    ref_ids = map(lambda r : r['_id'], refs)
+    c.add('test_sisdb', *map(lambda i : {
+        'name' : 'name%d' % i,
+        'living' : i % 2 == 0,
+        'age' : 20 + i,
+        'tags' : ['tag%d' % (i % 2)],
+        'nested' : { 'stuff' : 'stuff%d' % i, 'deep' : { 'x' : i } },
+        'reference' : ref_ids[i % len(ref_ids)] if ref_ids else None,
+        'refs' : ref_ids
+    }, range(num_items)))
+    c.calls.reset()
+    return c
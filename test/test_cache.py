@@ -0,0 +1,134 @@
+import unittest
+import gc
+import memsis
+import sispy
+import sisdb
+from sisdb import cache
+
+class TestIdentityMap(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.db = sisdb.SisDb(self.client, identity_map=True)
+        self.schema = self.db.test_sisdb
+        self.ids = map(lambda i : i['_id'], self.client.data['test_sisdb'])
+
+    def test_load_once(self):
+        obj = self.schema.load(self.ids[0])
+        self.client.calls.reset()
+        self.assertTrue(self.schema.load(self.ids[0]) is obj)
+        self.assertEqual(self.client.calls.count(), 0)
+
+    def test_query_shares_objects(self):
+        obj = self.schema.load(self.ids[1])
+        items = self.schema.objects().sort('age').all_items()
+        self.assertTrue(items[1] is obj)
+        self.assertEqual(self.schema.load_many(self.ids[:2])[self.ids[1]], obj)
+
+    def test_refresh_unchanged(self):
+        obj = self.schema.load(self.ids[0])
+        self.client.data['test_sisdb'][0]['name'] = 'renamed'
+        self.schema.objects().all_items()
+        self.assertEqual(obj.name, 'renamed')
+
+    def test_keep_pending_changes(self):
+        obj = self.schema.load(self.ids[0])
+        obj.name = 'mine'
+        self.client.data['test_sisdb'][0]['name'] = 'theirs'
+        self.schema.objects().all_items()
+        self.assertEqual(obj.name, 'mine')
+
+    def test_create_and_delete(self):
+        obj = self.schema(data={ 'name' : 'new' })
+        obj.save()
+        self.assertTrue(self.schema.load(obj._id) is obj)
+        obj_id = obj._id
+        obj.delete()
+        self.assertRaises(sispy.Error, self.schema.load, obj_id)
+
+    def test_query_bulk_delete(self):
+        obj = self.schema.load(self.ids[0])
+        self.schema.objects().bulk_delete({ 'q' : { '_id' : obj._id } })
+        self.assertEqual(self.db.identity_map.get('test_sisdb', obj._id), None)
+        self.assertRaises(sispy.Error, self.schema.load, obj._id)
+
+    def test_weak(self):
+        self.schema.load(self.ids[0])
+        gc.collect()
+        self.assertEqual(len(self.db.identity_map), 0)
+
+    def test_partial_objects_stay_out(self):
+        self.schema.objects().fields(['name']).all_items()
+        self.assertEqual(len(self.db.identity_map), 0)
+
+    def test_max_size(self):
+        identity_map = cache.IdentityMap(2)
+        objs = [object(), object(), object()]
+        for i, o in enumerate(objs):
+            identity_map.add('s', i, o)
+        self.assertEqual(len(identity_map), 2)
+        self.assertEqual(identity_map.get('s', 0), None)
+        # get makes 1 the most recently used
+        self.assertTrue(identity_map.get('s', 1) is objs[1])
+        identity_map.add('s', 3, object())
+        self.assertTrue(identity_map.get('s', 1) is objs[1])
+        self.assertEqual(identity_map.get('s', 2), None)
+
+class TestQueryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.query_cache = cache.QueryCache(ttl=60, max_size=100)
+        self.db = sisdb.SisDb(self.client, query_cache=self.query_cache)
+        self.schema = self.db.test_sisdb
+        self.client.calls.reset()
+
+    def _names(self, q):
+        return map(lambda o : o.name, q.all_items())
+
+    def test_shared_across_queries(self):
+        q = { 'living' : True }
+        first = self._names(self.schema.objects().filter(q).sort('age'))
+        second = self._names(self.schema.objects().filter(q).sort('age'))
+        self.assertEqual(first, second)
+        self.assertEqual(self.client.calls.count('fetch_page'), 1)
+
+    def test_pages_and_counts(self):
+        self.schema.objects().limit(2).page()
+        self.schema.objects().limit(2).page()
+        self.schema.objects().count()
+        self.schema.objects().count()
+        self.assertEqual(self.client.calls.count('fetch_page'), 2)
+
+    def test_results_are_copies(self):
+        obj = self.schema.objects().sort('age').all_items()[0]
+        obj.name = 'changed'
+        self.assertEqual(self.schema.objects().sort('age').all_items()[0].name, 'name0')
+
+    def test_save_invalidates(self):
+        obj = self.schema.objects().sort('age').all_items()[0]
+        obj.name = 'changed'
+        obj.save()
+        self.assertEqual(self.schema.objects().sort('age').all_items()[0].name, 'changed')
+        obj.delete()
+        self.assertEqual(len(self.schema.objects().all_items()), 4)
+
+    def test_ttl(self):
+        self.query_cache.ttl = -1
+        self.schema.objects().all_items()
+        self.schema.objects().all_items()
+        self.assertEqual(self.client.calls.count('fetch_page'), 2)
+
+    def test_max_size(self):
+        query_cache = cache.QueryCache(max_size=2)
+        query_cache.set('s', 'a', 1)
+        query_cache.set('s', 'b', 2)
+        self.assertEqual(query_cache.get('s', 'a'), 1)
+        query_cache.set('s', 'c', 3)
+        self.assertEqual(query_cache.get('s', 'b'), None)
+        self.assertEqual(query_cache.get('s', 'a'), 1)
+        query_cache.invalidate('s')
+        self.assertEqual(len(query_cache), 0)
+
+if __name__ == '__main__':
+    unittest.main()
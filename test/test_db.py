@@ -0,0 +1,369 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+import memsis
+import sispy
+import sisdb
+from sisdb import transport
+from sisdb import util
+
+class TestSchemaCache(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'schemas.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _fetches(self):
+        return map(lambda c : c[2], filter(lambda c : c[1] == 'schemas',
+                                           self.client.calls.log))
+
+    def test_cached(self):
+        db = sisdb.SisDb(self.client, schema_cache=self.path)
+        self.assertTrue(os.path.exists(self.path))
+        self.client.calls.reset()
+        cached = sisdb.SisDb(self.client, schema_cache=self.path)
+        # only the versions are fetched
+        self.assertEqual(map(lambda q : q.get('fields', None), self._fetches()),
+                         [sisdb.SCHEMA_VERSION_FIELDS])
+        self.assertEqual(sorted(cached.available_schemas()), sorted(db.available_schemas()))
+        self.assertEqual(cached.test_sisdb.objects().find_one({ 'name' : 'name1' }).age, 21)
+
+    def test_changed_schema(self):
+        sisdb.SisDb(self.client, schema_cache=self.path)
+        desc = dict(memsis.SCHEMA)
+        desc['definition'] = dict(desc['definition'], extra='String')
+        self.client.schemas.update('test_sisdb', desc)
+        self.client.calls.reset()
+        cached = sisdb.SisDb(self.client, schema_cache=self.path)
+        self.assertTrue('extra' in cached.test_sisdb.defn)
+        names = self._fetches()[1]['q']['name']['$in']
+        self.assertEqual(names, ['test_sisdb'])
+        # the cache was updated
+        self.client.calls.reset()
+        self.assertTrue('extra' in sisdb.SisDb(self.client, schema_cache=self.path).test_sisdb.defn)
+        self.assertEqual(len(self._fetches()), 1)
+
+    def test_unreadable(self):
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        db = sisdb.SisDb(self.client, schema_cache=self.path)
+        self.assertEqual(sorted(db.available_schemas()), ['test_sisdb', 'test_sisdb_ref'])
+
+    def test_lazy_classes(self):
+        db = sisdb.SisDb(self.client)
+        self.assertEqual(db._schemas, { })
+        db.test_sisdb
+        self.assertEqual(db._schemas.keys(), ['test_sisdb'])
+
+class TestRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.db = sisdb.SisDb(self.client)
+        self.client.calls.reset()
+
+    def _fetched(self):
+        # the queries made for schemas
+        return map(lambda c : c[2], filter(lambda c : c[1] == 'schemas',
+                                           self.client.calls.log))
+
+    def test_nothing_changed(self):
+        cls = self.db.test_sisdb
+        self.db.refresh()
+        self.assertTrue(self.db.test_sisdb is cls)
+        fetched = self._fetched()
+        self.assertEqual(len(fetched), 2)
+        self.assertTrue('$gte' in str(fetched[0]['q']))
+        self.assertEqual(fetched[1]['fields'], 'name')
+
+    def test_updated(self):
+        cls = self.db.test_sisdb
+        obj = cls.objects().find_one({ 'name' : 'name0' })
+        desc = dict(memsis.SCHEMA)
+        desc['definition'] = dict(desc['definition'], extra='String')
+        self.client.schemas.update('test_sisdb', desc)
+        self.db.refresh()
+        # updated in place
+        self.assertTrue(self.db.test_sisdb is cls)
+        self.assertTrue('extra' in cls.defn)
+        obj.extra = 'value'
+        self.assertEqual(obj.extra, 'value')
+
+    def test_created_and_deleted(self):
+        self.client.schemas.create({ 'name' : 'test_sisdb_new', 'owner' : ['sisdb'],
+                                     'definition' : { 'name' : 'String' } })
+        self.client.schemas.delete('test_sisdb_ref')
+        self.db.refresh()
+        self.assertEqual(sorted(self.db.available_schemas()), ['test_sisdb', 'test_sisdb_new'])
+        self.assertRaises(AttributeError, getattr, self.db, 'test_sisdb_ref')
+
+    def test_full(self):
+        self.db.refresh(full=True)
+        self.assertEqual(len(self._fetched()), 1)
+        self.assertFalse('q' in (self._fetched()[0] or { }))
+
+class TestAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client(num_items=10)
+        self.db = sisdb.SisDb(self.client, async_workers=4)
+        self.schema = self.db.test_sisdb
+        self.ids = map(lambda i : i['_id'], self.client.data['test_sisdb'])
+        self.client.calls.reset()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_load_and_get(self):
+        pending = map(self.schema.aload, self.ids[:3])
+        self.assertEqual(map(lambda p : p.get().name, pending), ['name0', 'name1', 'name2'])
+        self.assertEqual(self.schema.aget(name='name4').get().age, 24)
+
+    def test_save(self):
+        obj = self.schema(data={ 'name' : 'async' })
+        self.assertTrue(obj.asave().get() is obj)
+        self.assertEqual(self.schema.load(obj._id).name, 'async')
+        obj.adelete().get()
+        self.assertEqual(len(self.client.data['test_sisdb']), 10)
+
+    def test_query(self):
+        q = self.schema.objects().sort('age')
+        self.assertEqual(q.acount().get(), 10)
+        page = self.schema.objects().sort('age').limit(3).apage().get()
+        self.assertEqual(map(lambda o : o.name, page), ['name0', 'name1', 'name2'])
+        self.assertEqual(len(self.schema.objects().aall_items().get()), 10)
+
+    def test_errors(self):
+        self.client.error = sispy.Error('down', http_status_code=503)
+        pending = self.schema.objects().acount()
+        self.assertRaises(sispy.Error, pending.get)
+
+    def test_submit(self):
+        self.assertEqual(self.db.submit(lambda a, b=0 : a + b, 1, b=2).get(), 3)
+
+    def test_aiterate(self):
+        names = map(lambda o : o.name, self.schema.objects().sort('age').aiterate(page_size=3))
+        self.assertEqual(names, map(lambda i : 'name%d' % i, range(10)))
+
+    def test_aiterate_stop_early(self):
+        self.client.delay = 0.02
+        objs = self.schema.objects().sort('age').aiterate(page_size=2)
+        self.assertEqual(next(objs).name, 'name0')
+        objs.close()
+        fetched = self.client.calls.count('fetch_page')
+        # at most the page after the first was prefetched
+        self.assertTrue(fetched <= 2)
+        self.db.close()
+        self.assertEqual(self.client.calls.count('fetch_page'), fetched)
+
+    def test_close(self):
+        self.db.submit(lambda : None).get()
+        self.db.close()
+        self.assertEqual(self.db._async_pool, None)
+        # a new pool is made on the next call
+        self.assertEqual(self.db.submit(lambda : 1).get(), 1)
+
+def _run_threads(func, num_threads):
+    errors = []
+    def run(i):
+        try:
+            func(i)
+        except Exception as e:
+            errors.append(e)
+    threads = map(lambda i : threading.Thread(target=run, args=(i,)), range(num_threads))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+class TestThreads(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client(num_items=20)
+        self.db = sisdb.SisDb(self.client, identity_map=True,
+                              query_cache=sisdb.cache.QueryCache())
+
+    def test_build_schema(self):
+        classes = []
+        errors = _run_threads(lambda i : classes.append(self.db.test_sisdb), 8)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(classes)), 1)
+
+    def test_queries_and_refresh(self):
+        def work(i):
+            for j in range(5):
+                if i == 0:
+                    self.db.refresh()
+                objs = self.db.test_sisdb.objects().filter({ 'age' : { '$gte' : 20 + j } }).all_items()
+                assert len(objs) == 20 - j
+                obj = self.db.test_sisdb.load(objs[0]._id)
+                assert obj is self.db.test_sisdb.load(obj._id)
+        self.assertEqual(_run_threads(work, 8), [])
+
+    def test_saves(self):
+        objs = self.db.test_sisdb.objects().all_items()
+        def work(i):
+            objs[i].age = 100 + i
+            objs[i].save()
+        self.assertEqual(_run_threads(work, len(objs)), [])
+        ages = sorted(map(lambda i : i['age'], self.client.data['test_sisdb']))
+        self.assertEqual(ages, range(100, 120))
+
+class TestCoalesce(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.db = sisdb.SisDb(self.client, coalesce=True)
+        self.schema = self.db.test_sisdb
+        self.obj_id = self.client.data['test_sisdb'][0]['_id']
+        self.client.calls.reset()
+        self.client.delay = 0.1
+
+    def _load_all(self, num_threads):
+        objs = []
+        errors = _run_threads(lambda i : objs.append(self.schema.load(self.obj_id)), num_threads)
+        return objs, errors
+
+    def test_one_request(self):
+        objs, errors = self._load_all(8)
+        self.assertEqual(errors, [])
+        self.assertEqual(self.client.calls.count('get'), 1)
+        self.assertEqual(map(lambda o : o.name, objs), ['name0'] * 8)
+        # each caller has its own copy
+        self.assertEqual(len(set(map(lambda o : id(o._data), objs))), 8)
+
+    def test_queries(self):
+        counts = []
+        _run_threads(lambda i : counts.append(self.schema.objects().count()), 8)
+        self.assertEqual(counts, [5] * 8)
+        self.assertEqual(self.client.calls.count('fetch_page'), 1)
+
+    def test_errors_reach_every_waiter(self):
+        self.client.error = sispy.Error('down', http_status_code=503)
+        objs, errors = self._load_all(8)
+        self.assertEqual(len(errors), 8)
+        self.assertTrue(all(map(lambda e : isinstance(e, sispy.Error), errors)))
+        self.assertEqual(self.client.calls.count('get'), 1)
+
+    def test_off_by_default(self):
+        self.db = sisdb.SisDb(self.client)
+        self.schema = self.db.test_sisdb
+        self.client.calls.reset()
+        self._load_all(4)
+        self.assertEqual(self.client.calls.count('get'), 4)
+
+    def test_not_in_sessions(self):
+        def load(i):
+            with self.db.session():
+                self.schema.load(self.obj_id)
+        _run_threads(load, 4)
+        self.assertEqual(self.client.calls.count('get'), 4)
+
+    def test_single_flight(self):
+        single_flight = util.SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def slow():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return { 'value' : 1 }
+        results = []
+        leader = threading.Thread(target=lambda : results.append(single_flight.do('k', slow)))
+        leader.start()
+        started.wait()
+        waiter = threading.Thread(target=lambda : results.append(single_flight.do('k', slow)))
+        waiter.start()
+        while single_flight._calls['k'].waiters == 0:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        waiter.join()
+        self.assertEqual((len(calls), results), (1, [{ 'value' : 1 }] * 2))
+        self.assertTrue(results[0] is not results[1])
+        # finished calls aren't shared
+        single_flight.do('k', slow)
+        self.assertEqual(len(calls), 2)
+
+class Handler(object):
+    """ An http handler that records the requests in flight """
+
+    lock = threading.Lock()
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.closed = False
+        # closed like a requests.Session
+        self._session = self
+        pool.handlers.append(self)
+
+    def close(self):
+        self.closed = True
+
+    def request(self, request):
+        with self.lock:
+            self.pool.in_flight += 1
+            self.pool.max_in_flight = max(self.pool.max_in_flight, self.pool.in_flight)
+        try:
+            time.sleep(0.01)
+            if request == 'http error':
+                raise sispy.Error('not found', http_status_code=404)
+            if request == 'io error':
+                raise IOError('reset')
+            return request
+        finally:
+            with self.lock:
+                self.pool.in_flight -= 1
+
+class TestPooledHTTPHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.handlers = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.pool = transport.PooledHTTPHandler(max_size=3, factory=lambda: Handler(self))
+
+    def test_bounded(self):
+        results = []
+        errors = _run_threads(lambda i : results.append(self.pool.request(i)), 10)
+        self.assertEqual((errors, sorted(results)), ([], range(10)))
+        self.assertEqual(self.max_in_flight, 3)
+        self.assertEqual(len(self.handlers), 3)
+
+    def test_reuse(self):
+        self.pool.request('a')
+        self.pool.request('b')
+        self.assertEqual(len(self.handlers), 1)
+
+    def test_errors(self):
+        self.assertRaises(sispy.Error, self.pool.request, 'http error')
+        # the server answered so the handler is kept
+        self.pool.request('a')
+        self.assertEqual(len(self.handlers), 1)
+        self.assertRaises(IOError, self.pool.request, 'io error')
+        self.assertTrue(self.handlers[0].closed)
+        self.pool.request('a')
+        self.assertEqual(len(self.handlers), 2)
+
+    def test_close(self):
+        self.pool.request('a')
+        self.pool.close()
+        self.assertEqual(map(lambda h : h.closed, self.handlers), [True])
+
+    def test_db(self):
+        client = memsis.client()
+        db = sisdb.SisDb(client, http_handler=self.pool)
+        self.assertTrue(client._http_handler is self.pool)
+        db.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+import unittest
+import memsis
+import sisdb
+from sisdb import evaluator
+
+ITEMS = [
+    { '_id' : 'a', 'name' : 'one', 'living' : True, 'age' : 20, 'tags' : ['red'],
+      'nested' : { 'stuff' : 'inner' }, 'parts' : [{ 'x' : 1 }, { 'x' : 2 }] },
+    { '_id' : 'b', 'name' : 'two', 'living' : False, 'age' : 30, 'tags' : ['red', 'blue'],
+      'parts' : [{ 'x' : 3 }] },
+    { '_id' : 'c', 'name' : 'three', 'living' : True, 'age' : 40, 'tags' : [] },
+    { '_id' : 'd', 'name' : 'Tee', 'living' : False, 'age' : 50, 'tags' : ['green'],
+      'nested' : { 'stuff' : 'other' } },
+    { '_id' : 'e', 'name' : 'five', 'living' : True, 'age' : None },
+]
+
+def _ids(items):
+    return map(lambda i : i['_id'], items)
+
+class TestMatches(unittest.TestCase):
+
+    def _matching(self, q):
+        return _ids(filter(lambda i : evaluator.matches(i, q), ITEMS))
+
+    def test_comparisons(self):
+        self.assertEqual(self._matching({ }), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(self._matching({ 'age' : { '$gte' : 30, '$lt' : 50 } }), ['b', 'c'])
+        self.assertEqual(self._matching({ 'age' : { '$in' : [20, 50, 99] } }), ['a', 'd'])
+        self.assertEqual(self._matching({ 'age' : { '$nin' : [20, 50] } }), ['b', 'c', 'e'])
+        # only values of the same type compare
+        self.assertEqual(self._matching({ 'name' : { '$gt' : 't' } }), ['b', 'c'])
+        self.assertEqual(self._matching({ 'age' : { '$gt' : 't' } }), [])
+        self.assertEqual(self._matching({ 'living' : { '$gt' : False } }), ['a', 'c', 'e'])
+
+    def test_arrays(self):
+        # an array matches when any element does
+        self.assertEqual(self._matching({ 'tags' : 'red' }), ['a', 'b'])
+        self.assertEqual(self._matching({ 'tags' : ['red'] }), ['a'])
+        self.assertEqual(self._matching({ 'tags' : { '$in' : ['blue', 'green'] } }), ['b', 'd'])
+        self.assertEqual(self._matching({ 'tags' : { '$ne' : 'red' } }), ['c', 'd', 'e'])
+        self.assertEqual(self._matching({ 'tags' : { '$size' : 0 } }), ['c'])
+        self.assertEqual(self._matching({ 'tags' : { '$regex' : '^g' } }), ['d'])
+        # paths descend into arrays of objects
+        self.assertEqual(self._matching({ 'parts.x' : 2 }), ['a'])
+        self.assertEqual(self._matching({ 'parts.x' : { '$gt' : 1 } }), ['a', 'b'])
+
+    def test_missing(self):
+        self.assertEqual(self._matching({ 'nested.stuff' : None }), ['b', 'c', 'e'])
+        self.assertEqual(self._matching({ 'nested.stuff' : { '$exists' : False } }), ['b', 'c', 'e'])
+        self.assertEqual(self._matching({ 'age' : None }), ['e'])
+        self.assertEqual(self._matching({ 'age' : { '$exists' : True } }), ['a', 'b', 'c', 'd', 'e'])
+
+    def test_regex(self):
+        self.assertEqual(self._matching({ 'name' : { '$regex' : '^t' } }), ['b', 'c'])
+        self.assertEqual(self._matching({ 'name' : { '$regex' : '^t', '$options' : 'i' } }),
+                         ['b', 'c', 'd'])
+
+    def test_not_and_nor(self):
+        self.assertEqual(self._matching({ 'name' : { '$not' : { '$regex' : 'e$' } } }), ['b'])
+        self.assertEqual(self._matching({ 'age' : { '$not' : { '$gt' : 30 } } }), ['a', 'b', 'e'])
+        self.assertEqual(self._matching({ '$nor' : [{ 'living' : True }, { 'age' : 50 }] }), ['b'])
+        self.assertEqual(self._matching({ '$or' : [{ 'name' : 'one' }, { 'age' : 50 }] }), ['a', 'd'])
+        self.assertEqual(self._matching({ '$and' : [{ 'living' : False }, { 'tags' : 'red' }] }), ['b'])
+
+    def test_references(self):
+        # populated references compare by their _id
+        item = { 'ref' : { '_id' : 'r1', 'name' : 'ref' }, 'refs' : [{ '_id' : 'r2' }] }
+        self.assertTrue(evaluator.matches(item, { 'ref' : 'r1' }))
+        self.assertTrue(evaluator.matches(item, { 'refs' : { '$in' : ['r2'] } }))
+
+    def test_unsupported(self):
+        for q in [{ 'age' : { '$mod' : [2, 0] } },
+                  { '$where' : 'this.age > 1' },
+                  { '$or' : [{ 'name' : { '$elemMatch' : { } } }] },
+                  { 'name' : { '$not' : { '$type' : 2 } } }]:
+            self.assertRaises(evaluator.SisEvaluatorError, evaluator.validate, q)
+            self.assertRaises(evaluator.SisEvaluatorError, evaluator.matches, ITEMS[0], q)
+
+    def test_validate(self):
+        evaluator.validate(None)
+        evaluator.validate({ 'age' : { '$gt' : 1 }, '$or' : [{ 'name' : { '$not' : { '$regex' : 'x' } } }],
+                             'mixed' : { '$odd' : 1, 'key' : 2 } })
+
+class TestSort(unittest.TestCase):
+
+    def _sorted(self, items, sort):
+        return evaluator.sort_items(list(items), sort)
+
+    def test_keys(self):
+        self.assertEqual(_ids(self._sorted(ITEMS, 'name')), ['d', 'e', 'a', 'c', 'b'])
+        self.assertEqual(_ids(self._sorted(ITEMS, ['-living', '-age'])), ['c', 'a', 'e', 'd', 'b'])
+        self.assertEqual(evaluator.parse_sort('name,-age'), [('name', False), ('age', True)])
+
+    def test_mixed_types(self):
+        # missing and null, numbers, strings, objects, others, booleans
+        values = [True, 'b', 1, None, { 'k' : 1 }, [], 2.5, 'a', [3, 'z']]
+        items = map(lambda (i, v) : { '_id' : i, 'v' : v }, enumerate(values))
+        items.append({ '_id' : 'missing' })
+        ranks = map(lambda i : evaluator._sort_rank(i.get('v', evaluator._MISSING)), items)
+        self.assertEqual(map(lambda r : r[0], ranks), [5, 2, 1, 0, 3, 4, 1, 2, 4, 0])
+        ordered = map(lambda i : i.get('v', 'missing'), self._sorted(items, 'v'))
+        # arrays sort by their smallest element, empty ones first
+        self.assertEqual(ordered, [[], None, 'missing', 1, 2.5, [3, 'z'], 'a', 'b', { 'k' : 1 }, True])
+        ordered = map(lambda i : i.get('v', 'missing'), self._sorted(items, '-v'))
+        self.assertEqual(ordered, [True, { 'k' : 1 }, [3, 'z'], 'b', 'a', 2.5, 1, None, 'missing', []])
+
+class TestFetchPage(unittest.TestCase):
+
+    def test_paging(self):
+        q = { 'q' : { 'age' : { '$gte' : 30 } }, 'sort' : 'age', 'offset' : 1, 'limit' : 2 }
+        items, total = evaluator.fetch_page(ITEMS, q)
+        self.assertEqual((_ids(items), total), (['c', 'd'], 3))
+        items, total = evaluator.fetch_page(ITEMS, { 'sort' : '-age', 'offset' : 3 })
+        self.assertEqual((_ids(items), total), (['a', 'e'], 5))
+
+    def test_fields(self):
+        items = evaluator.fetch_page(ITEMS, { 'sort' : 'age', 'limit' : 1,
+                                              'fields' : 'name,nested.stuff,missing' })[0]
+        self.assertEqual(items, [{ '_id' : 'e', 'name' : 'five' }])
+        items = evaluator.fetch_page(ITEMS, { 'q' : { '_id' : 'a' }, 'fields' : ['nested.stuff'] })[0]
+        self.assertEqual(items, [{ '_id' : 'a', 'nested' : { 'stuff' : 'inner' } }])
+
+    def test_items_unchanged(self):
+        items = list(ITEMS)
+        evaluator.fetch_page(items, { 'sort' : 'name', 'fields' : 'name' })
+        self.assertEqual(items, ITEMS)
+
+class TestCachedScan(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.query_cache = sisdb.cache.QueryCache()
+        self.db = sisdb.SisDb(self.client, query_cache=self.query_cache)
+        self.schema = self.db.test_sisdb
+        self.schema.objects().all_items()
+        self.client.calls.reset()
+
+    def _names(self, q):
+        return map(lambda o : o.name, q.all_items())
+
+    def test_answered_locally(self):
+        q = self.schema.objects().filter({ 'age' : { '$gt' : 21 } }).sort('-age')
+        self.assertEqual(self._names(q), ['name4', 'name3', 'name2'])
+        self.assertEqual(self.schema.objects().filter({ 'living' : True }).count(), 3)
+        self.assertEqual(map(lambda o : o.name, self.schema.objects().sort('age').limit(2).page()),
+                         ['name0', 'name1'])
+        self.assertEqual(self.client.calls.count(), 0)
+
+    def test_decoded_once(self):
+        decoded = []
+        get_shared = self.query_cache.get_shared
+        def counting(name, key):
+            value = get_shared(name, key)
+            decoded.append(value)
+            return value
+        self.query_cache.get_shared = counting
+        self.schema.objects().filter({ 'living' : True }).all_items()
+        self.schema.objects().filter({ 'living' : False }).all_items()
+        self.assertEqual(len(decoded), 2)
+        self.assertTrue(decoded[0] is decoded[1])
+        # unsupported queries go to the server without reading the
+        # scan (and memsis can't answer them either)
+        q = self.schema.objects().filter({ 'age' : { '$mod' : [2, 0] } })
+        self.assertRaises(evaluator.SisEvaluatorError, q.all_items)
+        self.assertEqual(len(decoded), 2)
+        self.assertEqual(self.client.calls.count('fetch_page'), 1)
+
+    def test_results_are_copies(self):
+        obj = self.schema.objects().filter({ 'name' : 'name0' }).find_one()
+        obj.nested.stuff = 'changed'
+        obj = self.schema.objects().filter({ 'name' : 'name0' }).find_one()
+        self.assertEqual(obj.nested.stuff, 'stuff0')
+
+    def test_invalidated(self):
+        obj = self.schema.objects().filter({ 'name' : 'name0' }).find_one()
+        obj.age = 99
+        obj.save()
+        self.client.calls.reset()
+        self.assertEqual(self.schema.objects().filter({ 'age' : 99 }).count(), 1)
+        self.assertEqual(self.client.calls.count('fetch_page'), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+import unittest
+import math
+import memsis
+import sisdb
+
+def _names(objs):
+    return map(lambda o : o.name, objs)
+
+class TestSlicing(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.db = sisdb.SisDb(self.client)
+        self.schema = self.db.test_sisdb
+
+    def _query(self):
+        return self.schema.objects().sort('age').populate(False)
+
+    def test_iterate_slice(self):
+        self.assertEqual(_names(list(self._query()[1:3])), ['name1', 'name2'])
+        self.assertEqual(_names(self._query()[3:].all_items()), ['name3', 'name4'])
+        self.assertEqual(_names(list(self._query()[:2])), ['name0', 'name1'])
+        self.assertEqual(list(self._query()[5:]), [])
+
+    def test_fetches_window_only(self):
+        q = self._query()
+        self.client.calls.reset()
+        list(q[1:3])
+        pages = map(lambda c : (c[2]['offset'], c[2]['limit']), self.client.calls.log)
+        self.assertEqual(pages, [(1, 2)])
+
+    def test_len_slice(self):
+        self.assertEqual(len(self._query()), 5)
+        self.assertEqual(len(self._query()[1:3]), 2)
+        self.assertEqual(len(self._query()[3:10]), 2)
+        # count is the total, ignoring the window
+        self.assertEqual(self._query()[1:3].count(), 5)
+        q = self._query().limit(2)
+        q.page()
+        self.assertEqual((len(q), q.count()), (2, 5))
+        self.assertEqual(len(self._query()[1:3][1:]), 1)
+
+    def test_negative_bounds(self):
+        self.assertEqual(_names(list(self._query()[-2:])), ['name3', 'name4'])
+        self.assertEqual(_names(list(self._query()[1:-1])), ['name1', 'name2', 'name3'])
+        self.assertEqual(len(self._query()[-3:-1]), 2)
+        self.assertEqual(self._query()[-1].name, 'name4')
+        self.assertEqual(self._query()[1:4][-1].name, 'name3')
+
+    def test_index_after_all_items(self):
+        q = self._query()[2:4]
+        q.all_items()
+        self.assertEqual(q[0].name, 'name2')
+        self.assertEqual(_names(q.page()), ['name2', 'name3'])
+        self.assertRaises(IndexError, lambda: q[2])
+
+    def test_get_ambiguous(self):
+        self.assertEqual(self.schema.get(name='name1').age, 21)
+        self.assertEqual(self.schema.get(living=True), None)
+
+class TestIterate(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client(num_items=9)
+        self.db = sisdb.SisDb(self.client)
+        self.schema = self.db.test_sisdb
+        self.client.calls.reset()
+
+    def _query(self):
+        return self.schema.objects().sort('age')
+
+    def _pages(self):
+        return map(lambda c : (c[2]['offset'], c[2]['limit']), self.client.calls.log)
+
+    def test_pages(self):
+        names = _names(self._query().iterate(4))
+        self.assertEqual(names, map(lambda i : 'name%d' % i, range(9)))
+        self.assertEqual(self._pages(), [(0, 4), (4, 4), (8, 4)])
+
+    def test_stops_early(self):
+        objs = self._query().iterate(4)
+        self.assertEqual(_names([next(objs), next(objs)]), ['name0', 'name1'])
+        objs.close()
+        self.assertEqual(self.client.calls.count('fetch_page'), 1)
+
+    def test_limit(self):
+        names = _names(self._query()[1:8].iterate(4))
+        self.assertEqual(names, map(lambda i : 'name%d' % i, range(1, 8)))
+        self.assertEqual(self._pages(), [(1, 4), (5, 3)])
+
+    def test_capped_page_size(self):
+        # a server returning fewer rows than asked for isn't done
+        self.client.max_limit = 2
+        self.assertEqual(len(list(self._query().iterate(4))), 9)
+        self.assertEqual(map(lambda p : p[0], self._pages()), [0, 2, 4, 6, 8])
+        self.assertEqual(len(list(self._query().limit(5).iterate(4))), 5)
+        self.assertEqual(len(self._query().parallel(2, page_size=4).all_items()), 9)
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client(num_items=9)
+        self.db = sisdb.SisDb(self.client, fetch_workers=4)
+        self.schema = self.db.test_sisdb
+        self.client.calls.reset()
+
+    def _offsets(self):
+        return sorted(map(lambda c : c[2]['offset'], self.client.calls.log))
+
+    def test_all_items(self):
+        self.client.delay = 0.05
+        items = self.schema.objects().sort('age').parallel(4, page_size=2).all_items()
+        self.assertEqual(_names(items), map(lambda i : 'name%d' % i, range(9)))
+        self.assertEqual(self._offsets(), [0, 2, 4, 6, 8])
+        self.assertTrue(self.client.max_in_flight > 1)
+        self.assertTrue(self.client.max_in_flight <= 4)
+
+    def test_db_default(self):
+        q = self.schema.objects().sort('-age')
+        q._page_size = 4
+        self.assertEqual(len(q.all_items()), 9)
+        self.assertEqual(self._offsets(), [0, 4, 8])
+
+    def test_single_worker(self):
+        items = self.schema.objects().parallel(1, page_size=2).all_items()
+        self.assertEqual(len(items), 9)
+        self.assertEqual(self.client.calls.count('fetch_page'), 1)
+
+class TestProjection(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.db = sisdb.SisDb(self.client)
+        self.schema = self.db.test_sisdb
+        self.client.calls.reset()
+
+    def _query(self):
+        return self.schema.objects().sort('age')
+
+    def test_fields(self):
+        objs = self._query().fields(['name', 'nested.stuff']).all_items()
+        self.assertEqual(self.client.calls.log[0][2]['fields'], 'name,nested.stuff')
+        self.assertEqual(objs[0].name, 'name0')
+        self.assertEqual(objs[0].nested.stuff, 'stuff0')
+        self.assertEqual(objs[0].age, None)
+
+    def test_values(self):
+        items = self._query().values('name', 'nested.deep.x').all_items()
+        self.assertEqual(items[1], { 'name' : 'name1', 'nested.deep.x' : 1 })
+        raw = self._query().values().all_items()
+        self.assertEqual(raw[0], self.client.data['test_sisdb'][0])
+
+    def test_values_list(self):
+        rows = self._query().values_list('name', 'age').limit(2).page()
+        self.assertEqual(rows, [('name0', 20), ('name1', 21)])
+        names = list(self._query().values_list('name', flat=True).iterate(2))
+        self.assertEqual(names, _names(self._query().all_items()))
+
+    def test_values_list_errors(self):
+        self.assertRaises(sisdb.query.SisQueryError, self._query().values_list)
+        self.assertRaises(sisdb.query.SisQueryError,
+                          self._query().values_list, 'name', 'age', flat=True)
+
+class TestColumns(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client(num_items=4)
+        items = self.client.data['test_sisdb']
+        del items[1]['living']
+        del items[2]['age']
+        items[3]['created'] = '1970-01-02T00:00:00.500Z'
+        self.db = sisdb.SisDb(self.client)
+        self.query = self.db.test_sisdb.objects().sort('name')
+        self.fields = ['name', 'age', 'living', 'created', 'nested.deep.x']
+
+    def test_arrays(self):
+        cols = self.query.to_columns(self.fields, use_numpy=False, page_size=3)
+        self.assertEqual(cols['name'], ['name0', 'name1', 'name2', 'name3'])
+        self.assertEqual(cols['age'].typecode, 'd')
+        self.assertEqual(cols['age'][:2].tolist(), [20.0, 21.0])
+        self.assertTrue(math.isnan(cols['age'][2]))
+        # missing booleans are -1, not False
+        self.assertEqual(cols['living'].tolist(), [1, -1, 1, 0])
+        self.assertEqual(cols['created'][3], 86400.5)
+        self.assertTrue(math.isnan(cols['created'][0]))
+        self.assertEqual(list(cols['nested.deep.x']), [0, 1, 2, 3])
+
+    @unittest.skipIf(sisdb.query.numpy is None, 'numpy is not installed')
+    def test_numpy(self):
+        cols = self.query.to_columns(self.fields, page_size=3)
+        self.assertEqual(cols['age'].dtype.name, 'float64')
+        living = cols['living']
+        self.assertEqual(living.dtype.name, 'bool')
+        self.assertEqual(living.mask.tolist(), [False, True, False, False])
+        self.assertEqual(living.tolist(), [True, None, True, False])
+        self.assertEqual(cols['name'].dtype.name, 'object')
+
+    def test_empty(self):
+        cols = self.query.filter({ 'age' : 99 }).to_columns(['living'], use_numpy=False)
+        self.assertEqual(len(cols['living']), 0)
+        self.assertRaises(sisdb.query.SisQueryError, self.query.to_columns, [])
+
+class TestKeyset(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client(num_items=7)
+        # two rows share an age so _id breaks the tie
+        self.client.data['test_sisdb'][3]['age'] = 22
+        self.db = sisdb.SisDb(self.client)
+        self.schema = self.db.test_sisdb
+        self.client.calls.reset()
+
+    def _expected(self, sort):
+        return _names(self.schema.objects().sort(sort).all_items())
+
+    def test_all_items(self):
+        for sort in ['age', '-age', ['-nested.deep.x', 'name']]:
+            expected = self._expected(sort)
+            self.client.calls.reset()
+            items = self.schema.objects().sort(sort).keyset(2).all_items()
+            self.assertEqual(_names(items), expected, sort)
+            pages = filter(lambda c : c[0] == 'fetch_page', self.client.calls.log)
+            self.assertEqual(len(pages), 4)
+            # no offsets, the later pages filter on the last row
+            self.assertTrue(all(map(lambda c : 'offset' not in c[2], pages)))
+            self.assertTrue(all(map(lambda c : 'q' in c[2], pages[1:])))
+
+    def test_window(self):
+        expected = self._expected('age')
+        q = self.schema.objects().sort('age').keyset(2)
+        self.assertEqual(_names(q[1:6]), expected[1:6])
+        self.assertEqual(len(q[1:6]), 5)
+
+    def test_iterate_with_filter(self):
+        q = { 'living' : True }
+        expected = _names(self.schema.objects().filter(q).sort('-age').all_items())
+        items = self.schema.objects().filter(q).sort('-age').keyset(1).iterate(1)
+        self.assertEqual(_names(items), expected)
+
+    def test_fields(self):
+        # the sort keys are fetched even when not asked for
+        rows = self.schema.objects().sort('age').keyset(3).values_list('name', flat=True).all_items()
+        fields = self.client.calls.log[-1][2]['fields'].split(',')
+        self.assertEqual(sorted(fields), ['_id', 'age', 'name'])
+        self.assertEqual(rows, self._expected('age'))
+
+    def test_capped_page_size(self):
+        expected = self._expected('age')
+        self.client.max_limit = 2
+        q = self.schema.objects().sort('age').keyset(3)
+        self.assertEqual(_names(q.iterate(3)), expected)
+        self.assertEqual(_names(q.all_items()), expected)
+        self.assertEqual(_names(q[1:6]), expected[1:6])
+
+    def test_inserted_during_scan(self):
+        pages = self.schema.objects().sort('age').keyset(3)._iter_pages(3)
+        first = next(pages)
+        # a row inserted before the current position doesn't shift the pages
+        self.client.add('test_sisdb', { 'name' : 'early', 'age' : 1 })
+        rest = sum(pages, [])
+        names = map(lambda i : i['name'], first + rest)
+        self.assertEqual(names, self._expected('age')[1:])
+        self.assertEqual(len(set(names)), 7)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import unittest
+import time
+import memsis
+import sispy
+import sisdb
+from sisdb import replica
+
+def _names(objs):
+    return map(lambda o : o.name, objs)
+
+class TestReplica(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.db = sisdb.SisDb(self.client)
+        self.schema = self.db.test_sisdb
+        self.endpoint = self.client.entities('test_sisdb')
+        self.replica = self.db.replicate(['test_sisdb'], page_size=2)
+        self.client.calls.reset()
+
+    def tearDown(self):
+        self.replica.close()
+
+    def _local(self):
+        return self.schema.objects().local()
+
+    def test_sync(self):
+        self.assertEqual(len(self.replica.items('test_sisdb')), 5)
+        self.endpoint.update(self.client.data['test_sisdb'][0]['_id'], { 'age' : 99 })
+        self.client.add('test_sisdb', { 'name' : 'new', 'age' : 1 })
+        self.client.calls.reset()
+        self.replica.sync()
+        items = self.replica.items('test_sisdb')
+        self.assertEqual(len(items), 6)
+        self.assertEqual(max(map(lambda i : i['age'], items)), 99)
+        # only the changes are pulled
+        pages = filter(lambda c : c[2].get('limit', None) == 2, self.client.calls.log)
+        self.assertTrue(all(map(lambda c : '$gte' in str(c[2]['q']), pages)))
+        self.assertEqual(len(pages), 2)
+
+    def test_modified_during_scan(self):
+        ids = map(lambda i : i['_id'], self.client.data['test_sisdb'])
+        for i in ids[1:4]:
+            self.endpoint.update(i, { 'age' : 1 })
+        store = self.replica._store
+        def store_and_modify(name, items):
+            store(name, items)
+            if self.replica._store is store_and_modify:
+                self.replica._store = store
+                # one already scanned and one not yet
+                self.endpoint.update(ids[0], { 'age' : 50 })
+                self.endpoint.update(ids[3], { 'age' : 53 })
+        self.replica._store = store_and_modify
+        self.replica.sync()
+        self.replica.sync()
+        ages = dict(map(lambda i : (i['_id'], i['age']), self.replica.items('test_sisdb')))
+        self.assertEqual((ages[ids[0]], ages[ids[3]]), (50, 53))
+
+    def test_deletes(self):
+        self.endpoint.delete(self.client.data['test_sisdb'][0]['_id'])
+        self.replica.sync()
+        # deletes are only seen by a reconcile
+        self.assertEqual(len(self._local().all_items()), 5)
+        self.replica.reconcile()
+        self.assertEqual(_names(self._local().sort('age').all_items()),
+                         ['name1', 'name2', 'name3', 'name4'])
+
+    def test_capped_page_size(self):
+        client = memsis.client(num_items=7)
+        client.max_limit = 2
+        db = sisdb.SisDb(client)
+        local = db.replicate(['test_sisdb'])
+        try:
+            self.assertEqual(len(local.items('test_sisdb')), 7)
+            client.entities('test_sisdb').delete(client.data['test_sisdb'][0]['_id'])
+            local.reconcile()
+            self.assertEqual(len(local.items('test_sisdb')), 6)
+        finally:
+            local.close()
+
+    def test_incomplete_reconcile(self):
+        reconciled_at = self.replica._state('test_sisdb')[1]
+        ids = set(map(lambda i : i['_id'], self.client.data['test_sisdb'][1:]))
+        # the server counted more ids than the scan returned
+        self.replica._server_ids = lambda name : (ids, False)
+        self.replica.reconcile()
+        self.assertEqual(len(self.replica.items('test_sisdb')), 5)
+        self.assertEqual(self.replica._state('test_sisdb')[1], reconciled_at)
+        del self.replica._server_ids
+        self.assertEqual(self.replica._server_ids('test_sisdb')[1], True)
+
+    def test_local_queries(self):
+        q = self._local().filter({ 'living' : True }).sort('-age')
+        self.assertEqual(_names(q.all_items()), ['name4', 'name2', 'name0'])
+        self.assertEqual(q.count(), 3)
+        self.assertEqual(_names(self._local().sort('age')[1:3]), ['name1', 'name2'])
+        self.assertEqual(_names(self._local().sort('age').limit(2).page()), ['name0', 'name1'])
+        self.assertEqual(self._local().filter({ 'tags' : 'tag1' }).count(), 2)
+        self.assertEqual(self.client.calls.count(), 0)
+
+    def test_id_lookup(self):
+        item = self.client.data['test_sisdb'][2]
+        obj = self._local().find_one({ '_id' : item['_id'] })
+        self.assertEqual(obj.name, 'name2')
+        self.assertEqual(self._local().find_one({ '_id' : 'missing' }), None)
+
+    def test_unpopulated(self):
+        item = self.client.data['test_sisdb'][0]
+        raw = self._local().values().filter({ '_id' : item['_id'] }).all_items()[0]
+        self.assertEqual(raw['reference'], item['reference'])
+        self.assertEqual(self.client.calls.count(), 0)
+
+    def test_copies(self):
+        obj = self._local().sort('age').all_items()[0]
+        obj.name = 'changed'
+        obj.nested.deep.x = 9
+        raw = self._local().values().sort('age').all_items()[0]
+        raw['nested']['stuff'] = 'changed'
+        item = self._local().values().sort('age').all_items()[0]
+        self.assertEqual((item['name'], item['nested']), ('name0', { 'stuff' : 'stuff0', 'deep' : { 'x' : 0 } }))
+
+    def test_not_replicated(self):
+        self.assertRaises(sisdb.query.SisQueryError,
+                          self.db.test_sisdb_ref.objects().local().all_items)
+        self.assertRaises(replica.SisReplicaError, self.replica.sync, 'test_sisdb_ref')
+        self.assertRaises(replica.SisReplicaError, self.replica.items, 'test_sisdb_ref')
+
+    def _wait_for(self, cond):
+        deadline = time.time() + 5
+        while not cond() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(cond())
+
+    def test_start_stop(self):
+        self.client.add('test_sisdb', { 'name' : 'new' })
+        self.replica.start(0.01)
+        self._wait_for(lambda : self.replica.last_sync is not None)
+        self.assertEqual(len(self.replica.items('test_sisdb')), 6)
+        self.client.error = sispy.Error('down', http_status_code=500)
+        self._wait_for(lambda : self.replica.last_error is self.client.error)
+        self.client.error = None
+        self._wait_for(lambda : self.replica.last_error is None)
+        self.replica.stop()
+        self.assertEqual(self.replica._thread, None)
+        self.client.calls.reset()
+        time.sleep(0.05)
+        self.assertEqual(self.client.calls.count(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
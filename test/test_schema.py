@@ -0,0 +1,293 @@
+import unittest
+import datetime
+import weakref
+import memsis
+import sisdb
+
+class TestDereference(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.db = sisdb.SisDb(self.client, batch_dereference=True)
+        self.obj = self.db.test_sisdb.objects().populate(False).find_one()
+        self.client.calls.reset()
+
+    def test_iterate(self):
+        refs = [r for r in self.obj.refs]
+        self.assertEqual(map(lambda r : r.ref_name, refs), ['ref0', 'ref1', 'ref2'])
+        self.assertEqual(self.client.calls.count(), 1)
+
+    def test_list(self):
+        refs = list(self.obj.refs)
+        self.assertTrue(all(map(lambda r : isinstance(r, self.db.test_sisdb_ref), refs)))
+        self.assertEqual(self.client.calls.count(), 1)
+
+    def test_slice(self):
+        refs = self.obj.refs[1:]
+        self.assertEqual(map(lambda r : r.ref_name, refs), ['ref1', 'ref2'])
+        self.assertEqual(map(lambda r : r.ref_name, self.obj.refs[-1:]), ['ref2'])
+        self.assertEqual(self.client.calls.count(), 1)
+
+    def test_save_does_not_load(self):
+        self.obj.refs.append(self.client.data['test_sisdb_ref'][0]['_id'])
+        self.obj.save()
+        self.assertEqual(map(lambda c : c[0], self.client.calls.log), ['update'])
+
+    def test_unbatched(self):
+        self.db.batch_dereference = False
+        ref_ids = map(lambda r : r['_id'], self.client.data['test_sisdb_ref'])
+        # iterating and slicing leave the ids alone, indexing loads one
+        self.assertEqual(list(self.obj.refs), ref_ids)
+        self.assertEqual([r for r in self.obj.refs], ref_ids)
+        self.assertEqual(self.obj.refs[1:], ref_ids[1:])
+        self.assertEqual(self.client.calls.count(), 0)
+        self.assertEqual(self.obj.refs[0].ref_name, 'ref0')
+        self.assertEqual(map(lambda c : c[0], self.client.calls.log), ['get'])
+
+class TestBulkDelete(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client(num_items=9)
+        self.db = sisdb.SisDb(self.client, identity_map=True)
+        self.schema = self.db.test_sisdb
+        self.items = self.schema.objects().all_items()
+        self.client.calls.reset()
+
+    def test_chunks(self):
+        self.client.delay = 0.05
+        num_deleted, errors = self.schema.bulk_delete(self.items[:7], chunk_size=2, max_workers=3)
+        self.assertEqual((num_deleted, errors), (7, []))
+        chunks = map(lambda c : c[2]['q']['_id']['$in'], self.client.calls.log)
+        self.assertEqual(map(len, chunks), [2, 2, 2, 1])
+        self.assertTrue(1 < self.client.max_in_flight <= 3)
+        self.assertEqual(len(self.client.data['test_sisdb']), 2)
+
+    def test_identity_map(self):
+        self.schema.bulk_delete(self.items[:2])
+        self.assertEqual(self.db.identity_map.get('test_sisdb', self.items[0]._id), None)
+        self.assertTrue(self.db.identity_map.get('test_sisdb', self.items[2]._id) is self.items[2])
+
+    def test_empty(self):
+        self.assertEqual(self.schema.bulk_delete([]), (0, []))
+        self.assertEqual(self.client.calls.count(), 0)
+
+class TestBulkCreate(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client(num_items=0)
+        self.db = sisdb.SisDb(self.client)
+        self.schema = self.db.test_sisdb
+        self.client.calls.reset()
+
+    def _items(self, n):
+        for i in xrange(n):
+            yield { 'name' : 'bulk%d' % i, 'age' : i }
+
+    def test_chunks(self):
+        self.client.delay = 0.05
+        created = self.schema.bulk_create(self._items(7), chunk_size=2, max_workers=3)
+        self.assertEqual(map(lambda o : o.name, created), map(lambda i : 'bulk%d' % i, range(7)))
+        self.assertEqual(map(lambda c : len(c[2]), self.client.calls.log), [2, 2, 2, 1])
+        self.assertTrue(1 < self.client.max_in_flight <= 3)
+
+    def test_iter_errors(self):
+        self.client.reject.add('bulk1')
+        results = list(self.schema.bulk_create_iter(self._items(3), chunk_size=2))
+        self.assertEqual(map(lambda r : len(r[0]), results), [1, 1])
+        self.assertEqual(results[0][1][0]['value']['name'], 'bulk1')
+        self.assertEqual(results[1][1], [])
+
+    def test_single_item(self):
+        created = self.schema.bulk_create({ 'name' : 'one' })
+        self.assertEqual(map(lambda o : o.name, created), ['one'])
+        created = self.schema.bulk_create(self.schema(data={ 'name' : 'two' }))
+        self.assertEqual(map(lambda o : o.name, created), ['two'])
+        self.assertEqual(self.client.calls.count('create'), 2)
+
+class TestUpdateDiff(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.db = sisdb.SisDb(self.client)
+        self.schema = self.db.test_sisdb
+        self.obj = self.schema.objects().sort('age').populate(False).all_items()[0]
+        self.client.calls.reset()
+
+    def _sent(self):
+        self.obj.save()
+        updates = filter(lambda c : c[0] == 'update', self.client.calls.log)
+        return updates[-1][3] if updates else None
+
+    def test_top_level(self):
+        self.obj.age = 50
+        self.assertEqual(self._sent(), { 'age' : 50 })
+
+    def test_nested(self):
+        self.obj.nested.deep.x = 9
+        self.assertEqual(self._sent(), { 'nested' : { 'deep' : { 'x' : 9 } } })
+        self.assertEqual(self.schema.load(self.obj._id).nested.stuff, 'stuff0')
+
+    def test_mixed(self):
+        self.obj.mixed = { 'a' : 1, 'b' : 2 }
+        self.obj.save()
+        self.obj.mixed['b'] = 3
+        del self.obj.mixed['a']
+        self.assertEqual(self._sent(), { 'mixed' : { 'a' : None, 'b' : 3 } })
+
+    def test_list(self):
+        self.obj.tags.append('new')
+        self.assertEqual(self._sent(), { 'tags' : ['tag0', 'new'] })
+
+    def test_unchanged(self):
+        self.obj.age = 50
+        self.obj.age = 20
+        self.assertEqual(self._sent(), None)
+        self.assertEqual(self.client.calls.count(), 0)
+
+    def test_new_object(self):
+        obj = self.schema(data={ 'name' : 'new', 'nested' : { 'stuff' : 'x' } })
+        obj.save()
+        sent = self.client.calls.log[-1][2]
+        self.assertEqual(sent, { 'name' : 'new', 'nested' : { 'stuff' : 'x' } })
+
+class TestFieldReads(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.db = sisdb.SisDb(self.client)
+        self.schema = self.db.test_sisdb
+        item = dict(self.client.data['test_sisdb'][0])
+        item.update({ 'age' : '42', 'living' : 'true',
+                      'created' : '2014-01-14T15:24:44.168Z' })
+        self.obj = self.schema.from_server(item)
+
+    def test_converted_once(self):
+        created = self.obj.created
+        self.assertEqual(created, datetime.datetime(2014, 1, 14, 15, 24, 44, 168000))
+        self.assertTrue(self.obj.created is created)
+        self.assertTrue(self.obj.tags is self.obj.tags)
+        self.assertEqual((self.obj.age, self.obj.living), (42, True))
+        # converting isn't a change
+        self.assertEqual(len(self.obj._changed), 0)
+
+    def test_set_after_read(self):
+        self.obj.age
+        self.obj.age = '7'
+        self.assertEqual(self.obj.age, 7)
+        self.assertEqual(self.obj._changed, set(['age']))
+
+class TestAttributes(unittest.TestCase):
+
+    def setUp(self):
+        self.db = sisdb.SisDb(memsis.client())
+        self.obj = self.db.test_sisdb.objects().find_one({ 'name' : 'name0' })
+
+    def test_undeclared_attribute(self):
+        self.obj.tmp = 1
+        self.assertEqual(self.obj.tmp, 1)
+        self.obj.nested.tmp = 2
+        self.assertEqual(self.obj.nested.tmp, 2)
+        # not part of the data
+        self.assertEqual(len(self.obj._changed), 0)
+        self.assertTrue('tmp' not in self.obj._data)
+
+    def test_weakref(self):
+        self.assertTrue(weakref.ref(self.obj)() is self.obj)
+
+class TestEndpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.db = sisdb.SisDb(self.client)
+        self.schema = self.db.test_sisdb
+
+    def test_shared(self):
+        objs = self.schema.objects().all_items()
+        for o in objs:
+            o.age += 1
+            o.save()
+        self.schema.load(objs[0]._id)
+        self.schema.objects().count()
+        self.assertEqual(self.client.num_endpoints, 1)
+        self.assertTrue(objs[0].endpoint is objs[1].endpoint)
+
+    def test_update_schema(self):
+        endpoint = self.schema._get_endpoint()
+        desc = dict(self.schema.descriptor)
+        desc['definition'] = dict(desc['definition'], extra='String')
+        self.schema.update_schema(desc)
+        self.assertTrue(self.schema._get_endpoint() is not endpoint)
+        self.assertEqual(self.client.num_endpoints, 2)
+
+class TestFieldCache(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.client.schemas.create({
+            'name' : 'test_sisdb_other',
+            'owner' : ['sisdb'],
+            'definition' : {
+                'name' : 'String',
+                'nested' : memsis.SCHEMA['definition']['nested']
+            }
+        })
+        self.db = sisdb.SisDb(self.client)
+
+    def test_scalars_shared(self):
+        fields = self.db.test_sisdb.__dict__
+        other = self.db.test_sisdb_other.__dict__
+        self.assertTrue(fields['name'] is other['name'])
+        self.assertTrue(fields['nested'] is not other['nested'])
+        # fields of embedded schemas are scalars too
+        nested = fields['nested'].schema_cls.__dict__
+        other_nested = other['nested'].schema_cls.__dict__
+        self.assertTrue(nested['stuff'] is other_nested['stuff'])
+        self.assertTrue(nested['deep'] is not other_nested['deep'])
+
+    def test_embedded_per_schema(self):
+        nested = self.db.test_sisdb.nested.schema_cls
+        other = self.db.test_sisdb_other.nested.schema_cls
+        self.assertTrue(nested is not other)
+        self.assertEqual(nested.__name__, 'test_sisdb__nested')
+        self.assertEqual(other.__name__, 'test_sisdb_other__nested')
+
+    def test_reused_on_update(self):
+        cls = self.db.test_sisdb
+        name_field = cls.__dict__['name']
+        nested = cls.nested.schema_cls
+        desc = dict(cls.descriptor)
+        desc['definition'] = dict(desc['definition'], extra='String')
+        cls.update_schema(desc)
+        self.assertTrue(cls.__dict__['name'] is name_field)
+        self.assertTrue(cls.nested.schema_cls is nested)
+
+    def test_size_limit(self):
+        size = sisdb.field.FIELD_CACHE_SIZE
+        sisdb.field.FIELD_CACHE_SIZE = 5
+        try:
+            self.db.test_sisdb
+            self.db.test_sisdb_other
+            self.assertEqual(len(self.db._field_cache), 5)
+        finally:
+            sisdb.field.FIELD_CACHE_SIZE = size
+
+class TestFromServer(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.db = sisdb.SisDb(self.client)
+        self.schema = self.db.test_sisdb
+
+    def test_undeclared_keys(self):
+        self.client.data['test_sisdb'][0]['extra'] = 'not in the schema'
+        obj = self.schema.objects().sort('age').all_items()[0]
+        same = self.schema(data=self.client.data['test_sisdb'][0], from_server=True)
+        self.assertTrue('extra' not in obj._data)
+        self.assertTrue('extra' not in same._data)
+        self.assertEqual(obj, same)
+        obj.age = 1
+        obj.save()
+        self.assertTrue('extra' not in obj._data)
+
+if __name__ == '__main__':
+    unittest.main()
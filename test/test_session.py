@@ -0,0 +1,59 @@
+import unittest
+import memsis
+import sisdb
+from sisdb import session
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        self.client = memsis.client()
+        self.db = sisdb.SisDb(self.client)
+        self.schema = self.db.test_sisdb
+        self.client.calls.reset()
+
+    def _kinds(self):
+        return map(lambda c : c[0], self.client.calls.log)
+
+    def test_batched(self):
+        existing = self.schema.objects().sort('age').all_items()
+        self.client.calls.reset()
+        with self.db.session():
+            new = map(lambda i : self.schema(data={ 'name' : 'new%d' % i }).save(), range(3))
+            existing[0].name = 'changed0'
+            existing[1].name = 'changed1'
+            existing[2].delete()
+            self.assertEqual(self.client.calls.count(), 0)
+        self.assertEqual(self._kinds(), ['create', 'update_bulk', 'delete_bulk'])
+        self.assertTrue(all(map(lambda o : o._id is not None, new)))
+        self.assertEqual(self.schema.load(existing[1]._id).name, 'changed1')
+        self.assertEqual(len(self.client.data['test_sisdb']), 7)
+
+    def test_failed_creates(self):
+        self.client.reject.add('bad')
+        objs = map(lambda n : self.schema(data={ 'name' : n }), ['a', 'bad', 'b'])
+        try:
+            with self.db.session():
+                for o in objs:
+                    o.save()
+            self.fail('expected a SisSessionError')
+        except session.SisSessionError as e:
+            # the server returned the failed item with defaults added
+            self.assertEqual(len(e.errors), 1)
+            self.assertTrue(e.errors[0][0] is objs[1])
+        self.assertTrue(objs[0]._id is not None)
+        self.assertEqual(objs[1]._id, None)
+        self.assertEqual(self.schema.load(objs[2]._id).name, 'b')
+
+    def test_failed_positions(self):
+        items = [{ 'a' : 1 }, { 'a' : 1 }, { 'a' : 2 }]
+        # by value in request order or by index
+        failed, unmatched = session._failed_positions(
+            items, [{ 'value' : { 'a' : 1 } }, { 'index' : 2 }, { 'value' : { 'a' : 3 } }])
+        self.assertEqual(sorted(failed.keys()), [0, 2])
+        self.assertEqual(unmatched, [{ 'value' : { 'a' : 3 } }])
+        failed, unmatched = session._failed_positions(
+            items, [{ 'value' : { 'a' : 1 } }, { 'value' : { 'a' : 1 } }])
+        self.assertEqual(sorted(failed.keys()), [0, 1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,10 @@
 import unittest
+import os
+import shutil
+import tempfile
 import sispy
 import sisdb
+from sisdb import evaluator
 
 class TestSisDb(unittest.TestCase):
 
@@ -100,5 +104,195 @@ class TestSisDb(unittest.TestCase):
         self.assertEqual(len(results), 1)
         self.assertEqual(q.count(), 2)
 
+    def test_3_batch_dereference(self):
+        db = sisdb.SisDb(self.client, batch_dereference=True)
+        results = db.test_sisdb_schema.objects().populate(False).all_items()
+        self.assertEqual(len(results), 1)
+        ref = results[0]._data['reference']
+        self.assertTrue(isinstance(ref, db.ref_sisdb_schema))
+        self.assertEqual(ref.ref_name, 'foo')
+
+    def test_4_iterate(self):
+        q = self.db.ref_sisdb_schema.objects().sort('type')
+        results = [r.ref_name for r in q.iterate(page_size=1)]
+        self.assertEqual(results, ['foo', 'bar'])
+
+        results = [r.ref_name for r in q.limit(1).iterate(page_size=1)]
+        self.assertEqual(results, ['foo'])
+
+    def test_5_index_and_get(self):
+        q = self.db.ref_sisdb_schema.objects().sort('type')
+        self.assertEqual(q[0].ref_name, 'foo')
+        self.assertEqual(q[-1].ref_name, 'bar')
+        self.assertRaises(IndexError, lambda: q[2])
+        self.assertEqual([r.ref_name for r in q[1:].page()], ['bar'])
+
+        ref = self.db.ref_sisdb_schema.get(ref_name='bar')
+        self.assertEqual(ref.type, 11)
+        self.assertIsNone(self.db.ref_sisdb_schema.get(ref_name='nope'))
+
+    def test_6_session(self):
+        ref_schema = self.db.ref_sisdb_schema
+        with self.db.session():
+            ref3 = ref_schema()
+            ref3.ref_name = 'baz'
+            ref3.type = 12
+            ref3.save()
+            self.assertIsNone(ref3._id)
+            ref1 = ref_schema.get(ref_name='foo')
+            ref1.type = 20
+
+        self.assertIsNotNone(ref3._id)
+        self.assertEqual(ref_schema.get(ref_name='foo').type, 20)
+
+        with self.db.session():
+            ref3.delete()
+        self.assertIsNone(ref_schema.get(ref_name='baz'))
+
+    def test_7_partial_update(self):
+        schema = self.db.test_sisdb_schema
+        s1 = schema.get(name='schema')
+        s1.mixed['a'] = 'changed'
+        s1.nested.stuff = 'other stuff'
+        self.assertEqual(s1.to_saved_dict(True), {
+            'mixed' : { 'a' : 'changed' },
+            'nested' : { 'stuff' : 'other stuff' }
+        })
+        s1.save()
+
+        s1 = schema.get(name='schema')
+        self.assertEqual(s1.mixed, { 'a' : 'changed', 'object' : ['lives', 'here'] })
+        self.assertEqual(s1.nested.stuff, 'other stuff')
+
+    def test_8_schema_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'schemas.json')
+        try:
+            db = sisdb.SisDb(self.client, schema_cache=path)
+            self.assertTrue(os.path.exists(path))
+            cached = sisdb.SisDb(self.client, schema_cache=path)
+            self.assertEqual(sorted(db.available_schemas()),
+                             sorted(cached.available_schemas()))
+            self.assertEqual(cached.test_sisdb_schema.defn,
+                             db.test_sisdb_schema.defn)
+            s1 = cached.test_sisdb_schema.get(name='schema')
+            self.assertEqual(s1.nested.stuff, 'other stuff')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_9_async(self):
+        ref_schema = self.db.ref_sisdb_schema
+        refs = ref_schema.objects().all_items()
+        pending = map(lambda r : ref_schema.aload(r._id), refs)
+        loaded = map(lambda p : p.get(), pending)
+        self.assertEqual(map(lambda r : r.ref_name, loaded),
+                         map(lambda r : r.ref_name, refs))
+        self.assertEqual(ref_schema.objects().acount().get(), len(refs))
+        names = map(lambda r : r.ref_name, ref_schema.objects().aiterate(page_size=1))
+        self.assertEqual(sorted(names), sorted(map(lambda r : r.ref_name, refs)))
+        self.db.close()
+
+# run each query against the server and the local evaluator
+# and compare the results
+QUERIES = [
+    { },
+    { 'name' : 'one' },
+    { 'age' : { '$gt' : 30 } },
+    { 'age' : { '$gte' : 30, '$lt' : 50 } },
+    { 'age' : { '$lte' : 30 } },
+    { 'age' : { '$ne' : 30 } },
+    { 'age' : { '$in' : [20, 40, 99] } },
+    { 'age' : { '$nin' : [20, 40] } },
+    { 'tags' : 'red' },
+    { 'tags' : { '$in' : ['blue', 'green'] } },
+    { 'tags' : { '$size' : 0 } },
+    { 'nested.stuff' : 'inner' },
+    { 'nested.stuff' : { '$exists' : True } },
+    { 'nested.stuff' : { '$exists' : False } },
+    { 'nested.stuff' : None },
+    { 'name' : { '$regex' : '^t' } },
+    { 'name' : { '$regex' : '^T', '$options' : 'i' } },
+    { 'name' : { '$not' : { '$regex' : 'e$' } } },
+    { 'living' : True, 'age' : { '$gt' : 25 } },
+    { '$or' : [{ 'name' : 'one' }, { 'age' : 50 }] },
+    { '$and' : [{ 'living' : False }, { 'tags' : 'red' }] },
+    { '$nor' : [{ 'living' : True }] },
+]
+
+SORTS = [
+    ['age'],
+    ['-age'],
+    ['name'],
+    ['-living', 'age'],
+]
+
+ENTITIES = [
+    { 'name' : 'one', 'living' : True, 'age' : 20, 'tags' : ['red'], 'nested' : { 'stuff' : 'inner' } },
+    { 'name' : 'two', 'living' : False, 'age' : 30, 'tags' : ['red', 'blue'] },
+    { 'name' : 'three', 'living' : True, 'age' : 40, 'tags' : [] },
+    { 'name' : 'Tee', 'living' : False, 'age' : 50, 'tags' : ['green'], 'nested' : { 'stuff' : 'other' } },
+    { 'name' : 'five', 'living' : True, 'age' : 60 },
+]
+
+class TestEvaluatorServer(unittest.TestCase):
+
+    def setUp(self):
+        self.client = sispy.Client(url='http://localhost:3000')
+        self.client.authenticate('test', 'abc123')
+        try:
+            self.client.schemas.delete('test_sisdb_eval')
+        except sispy.Error:
+            pass
+        self.db = sisdb.SisDb(self.client)
+        self.db.update_schema({
+            'name' : 'test_sisdb_eval',
+            'owner' : ['sisdb'],
+            'definition' : {
+                'name' : 'String',
+                'living' : 'Boolean',
+                'age' : 'Number',
+                'tags' : ['String'],
+                'nested' : { 'stuff' : 'String' }
+            }
+        })
+        self.schema = self.db.test_sisdb_eval
+        self.schema.bulk_create(ENTITIES)
+        self.items = self.schema.objects().populate(False).values().all_items()
+
+    def tearDown(self):
+        self.client.schemas.delete('test_sisdb_eval')
+
+    def _ids(self, items):
+        return map(lambda i : i['_id'], items)
+
+    def test_queries(self):
+        for q in QUERIES:
+            server = self.schema.objects().filter(q).populate(False).values().all_items()
+            local = evaluator.fetch_page(self.items, { 'q' : q })[0]
+            self.assertEqual(sorted(self._ids(server)), sorted(self._ids(local)), q)
+
+    def test_sorts(self):
+        for sort in SORTS:
+            server = self.schema.objects().sort(sort).populate(False).values().all_items()
+            local = evaluator.fetch_page(self.items, { 'sort' : ','.join(sort) })[0]
+            self.assertEqual(self._ids(server), self._ids(local), sort)
+
+    def test_paging(self):
+        q = { 'q' : { 'age' : { '$gte' : 30 } }, 'sort' : 'age', 'offset' : 1, 'limit' : 2 }
+        server = self.client.entities('test_sisdb_eval').fetch_page(q)
+        local, total = evaluator.fetch_page(self.items, q)
+        self.assertEqual(self._ids(server), self._ids(local))
+        self.assertEqual(server._meta.total_count, total)
+
+    def test_cached_scan(self):
+        db = sisdb.SisDb(self.client, query_cache=sisdb.cache.QueryCache())
+        schema = db.test_sisdb_eval
+        schema.objects().all_items()
+        q = { 'age' : { '$gt' : 30 } }
+        # answered from the cached scan
+        local = map(lambda o : o._id, schema.objects().filter(q).sort('age').all_items())
+        server = map(lambda o : o._id, self.schema.objects().filter(q).sort('age').all_items())
+        self.assertEqual(local, server)
+
 if __name__ == '__main__':
     unittest.main()